@@ -0,0 +1,242 @@
+"""The benchmarks themselves.
+
+Each benchmark is a function that sets up whatever state it needs and returns
+the callable to time. Sizes are meant to be realistic: a listing page is 100
+updates, and the activity job sees 10k events with 1M visitor columns
+between them (scaled by --scale).
+
+"""
+
+import datetime
+import itertools
+import random
+import uuid
+
+import fakes
+
+
+BENCHMARKS = []
+
+NUM_UPDATES = 100
+NUM_AUTHORS = 10
+NUM_EVENTS = 10000
+NUM_VISITORS = 1000000
+
+
+def benchmark(name):
+    def benchmark_decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return benchmark_decorator
+
+
+def _make_event(id="benchmark", num_reporters=NUM_AUTHORS):
+    from reddit_liveupdate.models import LiveUpdateEvent
+
+    event = LiveUpdateEvent(id, title="a benchmark event",
+                            timezone="America/Los_Angeles")
+    for i in xrange(num_reporters):
+        reporter = fakes.Account._register(i + 1, "reporter%d" % i)
+        event.add_reporter(reporter)
+    event._commit()
+    return event
+
+
+def _make_updates(count=NUM_UPDATES, hours=24):
+    """Return `count` rendered updates spread over the last `hours` hours."""
+    from reddit_liveupdate.models import LiveUpdate
+
+    now = datetime.datetime.utcnow()
+    updates = []
+    for i in xrange(count):
+        created = now - datetime.timedelta(hours=hours * float(i) / count)
+        # a version 1 uuid for the right time, like the real ones
+        timestamp = int((created - datetime.datetime(1582, 10, 15))
+                        .total_seconds() * 1e7)
+        id = uuid.UUID(fields=(
+            timestamp & 0xffffffff,
+            (timestamp >> 32) & 0xffff,
+            ((timestamp >> 48) & 0x0fff) | 0x1000,
+            0x80 | random.getrandbits(6),
+            random.getrandbits(8),
+            random.getrandbits(48),
+        ))
+
+        update = LiveUpdate(id=id, data={
+            "author_id": i % NUM_AUTHORS + 1,
+            "body": "update number %d with some **markdown** in it" % i,
+        })
+        update.render_body()
+        updates.append(update)
+    return updates
+
+
+def _new_request(event):
+    fakes.reset_request(liveupdate_event=event)
+
+
+@benchmark("LiveUpdate.from_json")
+def bench_from_json(scale):
+    from reddit_liveupdate.models import LiveUpdate
+
+    columns = [(update._id, update.to_json()) for update in _make_updates()]
+
+    def run():
+        for id, value in columns:
+            update = LiveUpdate.from_json(id, value)
+            # what the listing reads off every update
+            update.deleted, update.author_id, update.body_html
+    return run
+
+
+@benchmark("LiveUpdate.to_json")
+def bench_to_json(scale):
+    updates = _make_updates()
+
+    def run():
+        for update in updates:
+            update.stricken = False  # make sure it really re-encodes
+            update.to_json()
+    return run
+
+
+@benchmark("LiveUpdateStream._column_to_obj")
+def bench_column_to_obj(scale):
+    from reddit_liveupdate.models import LiveUpdateStream
+
+    columns = [(update._id, update.to_json()) for update in _make_updates()]
+
+    def run():
+        # _column_to_obj consumes its input, just like the real query's
+        LiveUpdateStream._column_to_obj([{id: value}
+                                         for id, value in columns])
+    return run
+
+
+@benchmark("LiveUpdateListing.things_with_separators")
+def bench_things_with_separators(scale):
+    from reddit_liveupdate import pages
+
+    event = _make_event()
+    _new_request(event)
+
+    listing = pages.LiveUpdateListing(builder=None)
+    listing.things = _make_updates()
+
+    def run():
+        listing.things_with_separators()
+    return run
+
+
+@benchmark("pretty_time")
+def bench_pretty_time(scale):
+    from reddit_liveupdate import utils
+
+    event = _make_event()
+    dates = [update._date for update in _make_updates()]
+
+    def run():
+        _new_request(event)
+        for date in dates:
+            utils.pretty_time(date)
+    return run
+
+
+@benchmark("pretty_time (cold cache)")
+def bench_pretty_time_cold(scale):
+    from reddit_liveupdate import utils
+
+    event = _make_event()
+    dates = [update._date for update in _make_updates()]
+
+    def run():
+        utils._pretty_time_cache.clear()
+        _new_request(event)
+        for date in dates:
+            utils.pretty_time(date)
+    return run
+
+
+@benchmark("liveupdate_add_props")
+def bench_add_props(scale):
+    from reddit_liveupdate import pages
+
+    event = _make_event()
+    updates = _make_updates()
+
+    def run():
+        _new_request(event)
+        wrapped = [fakes.Wrapped(update) for update in updates]
+        pages.liveupdate_add_props(None, wrapped)
+    return run
+
+
+def _bench_pixel(flush_interval):
+    from reddit_liveupdate.controllers import LiveUpdatePixelController
+
+    fakes.g.liveupdate_pixel_flush_interval = flush_interval
+    controller = LiveUpdatePixelController()
+    visitors = itertools.count()
+
+    def run():
+        fakes.reset_request()
+        fakes.request.environ["extension"] = "png"
+        fakes.request.ip = "10.0.%d" % next(visitors)
+        controller.GET_pixel("benchmark")
+    return run
+
+
+@benchmark("GET_pixel")
+def bench_pixel(scale):
+    return _bench_pixel(flush_interval=0)
+
+
+@benchmark("GET_pixel (buffered)")
+def bench_pixel_buffered(scale):
+    return _bench_pixel(flush_interval=60)
+
+
+def _populate_visitors(num_events, num_visitors):
+    """Spread the visitors across the events, a few big events first."""
+    from reddit_liveupdate.models import (
+        ActiveVisitorSketchesByLiveUpdateEvent,
+        ActiveVisitorsByLiveUpdateEvent,
+        LiveUpdateActiveEventsIndex,
+    )
+
+    # so that every event is (re)marked active and its sketch (re)written in
+    # the freshly reset fakes
+    LiveUpdateActiveEventsIndex._last_marked.clear()
+    ActiveVisitorSketchesByLiveUpdateEvent._sketches_minute = None
+
+    weights = [1. / (rank + 1) for rank in xrange(num_events)]
+    total_weight = sum(weights)
+
+    visitors = itertools.count()
+    for rank, weight in enumerate(weights):
+        event_id = "event%d" % rank
+        count = max(1, int(num_visitors * weight / total_weight))
+        hashes = ["%040x" % next(visitors) for i in xrange(count)]
+        ActiveVisitorsByLiveUpdateEvent.touch_multi(event_id, hashes)
+
+
+def _bench_update_activity(scale, counter):
+    from reddit_liveupdate import activity
+
+    fakes.g.liveupdate_visitor_counter = counter
+    _populate_visitors(int(NUM_EVENTS * scale), int(NUM_VISITORS * scale))
+
+    def run():
+        activity.update_activity()
+        del fakes.sent_broadcasts[:]
+    return run
+
+
+@benchmark("update_activity")
+def bench_update_activity(scale):
+    return _bench_update_activity(scale, counter="columns")
+
+
+@benchmark("update_activity (hll)")
+def bench_update_activity_hll(scale):
+    return _bench_update_activity(scale, counter="hll")
@@ -0,0 +1,861 @@
+"""In-memory stand-ins for everything the plugin talks to.
+
+install() puts fake versions of pylons, pycassa and the parts of r2 that the
+plugin imports into sys.modules so that the plugin's modules can be imported
+and exercised without a reddit install, Cassandra, memcached or RabbitMQ.
+Only the pieces the plugin actually relies on behave like the real thing;
+everything else it imports is a do-nothing Stub.
+
+pytz and Babel are used for real, so they need to be installed.
+
+Every fake backend counts the calls made to it in `backend_calls`, which is
+handy for seeing how many round trips a code path would make. Calls made
+inside a tag_backend_calls() block are also counted against that tag in
+`tagged_backend_calls`.
+
+"""
+
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+import pytz
+from babel.core import Locale
+
+
+backend_calls = collections.Counter()
+tagged_backend_calls = collections.Counter()
+_backend_calls_lock = threading.Lock()
+_backend_call_tag = threading.local()
+_process_tag = None
+
+
+def _count_call(name):
+    # threads started by the code being measured (like activity's worker
+    # pool) don't have a tag of their own, so they count towards whatever
+    # tag was most recently set
+    tag = (getattr(_backend_call_tag, "tag", None) or _process_tag or
+           "untagged")
+    with _backend_calls_lock:
+        backend_calls[name] += 1
+        tagged_backend_calls[(tag, name)] += 1
+
+
+@contextlib.contextmanager
+def tag_backend_calls(tag):
+    """Count backend calls made by this thread in the block against tag."""
+    global _process_tag
+
+    previous = getattr(_backend_call_tag, "tag", None)
+    _backend_call_tag.tag = _process_tag = tag
+    try:
+        yield
+    finally:
+        _backend_call_tag.tag = previous
+
+
+class _StubType(type):
+    def __getattr__(cls, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub()
+
+
+class Stub(object):
+    """Stands in for any class, instance, function or decorator."""
+
+    __metaclass__ = _StubType
+
+    def __new__(cls, *args, **kwargs):
+        # used as a bare decorator: hand back what's being decorated
+        if len(args) == 1 and not kwargs and isinstance(
+                args[0], (types.FunctionType, type, classmethod)):
+            return args[0]
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and callable(args[0]):
+            return args[0]
+        return Stub()
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub()
+
+    def __add__(self, other):
+        return other
+
+    __radd__ = __add__
+
+
+class StubModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        stub = _StubType(name, (Stub,), {})
+        setattr(self, name, stub)
+        return stub
+
+
+def _module(name, **attrs):
+    module = StubModule(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+    parent_name, _, child_name = name.rpartition(".")
+    if parent_name:
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+
+class Bag(object):
+    """An attribute bag like pylons' `c` and `g`."""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+    def reset(self, **attrs):
+        self.__dict__.clear()
+        self.__dict__.update(attrs)
+
+
+# r2.lib.lock
+class TimeoutExpired(Exception):
+    pass
+
+
+class FakeLock(object):
+    def __init__(self, group, key, time=30, timeout=30, verbose=True):
+        self.key = "lock_" + key
+        self.timeout = timeout
+
+    def acquire(self):
+        start = time.time()
+        while not g.cache.add(self.key, 1):
+            if time.time() - start >= self.timeout:
+                raise TimeoutExpired
+            time.sleep(0.01)
+
+    def release(self):
+        g.cache.data.pop(self.key, None)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# memcache
+class FakeCache(object):
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        _count_call("cache.get")
+        return self.data.get(key, default)
+
+    def get_multi(self, keys, prefix=""):
+        _count_call("cache.get_multi")
+        return dict((key, self.data[prefix + key]) for key in keys
+                    if prefix + key in self.data)
+
+    def set(self, key, value, time=0):
+        _count_call("cache.set")
+        self.data[key] = value
+
+    def set_multi(self, mapping, prefix="", time=0):
+        _count_call("cache.set_multi")
+        for key, value in mapping.iteritems():
+            self.data[prefix + key] = value
+
+    def add(self, key, value, time=0):
+        _count_call("cache.add")
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = value
+            return True
+
+    def incr(self, key, delta=1):
+        _count_call("cache.incr")
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data[key] += delta
+            return self.data[key]
+
+    def delete(self, key):
+        _count_call("cache.delete")
+        self.data.pop(key, None)
+
+
+# cassandra
+class NotFoundException(Exception):
+    pass
+
+
+class TransientError(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+def convert_uuid_to_time(id):
+    return (id.time - 0x01B21DD213814000) / 1e7
+
+
+def _column_sort_key(name):
+    if isinstance(name, uuid.UUID):
+        return (name.time, name.bytes)
+    return name
+
+
+class FakeBatch(object):
+    def __init__(self, cf):
+        self.cf = cf
+
+    def insert(self, key, columns, ttl=None, timestamp=None):
+        self.cf._insert(key, columns)
+
+    def remove(self, key, columns=None):
+        self.cf._remove(key, columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        _count_call("%s.batch" % self.cf.name)
+
+
+class FakeColumnFamily(object):
+    """A pycassa ColumnFamily work-alike backed by dicts."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def _insert(self, key, columns):
+        with self.lock:
+            self.rows.setdefault(key, {}).update(columns)
+
+    def _remove(self, key, columns):
+        with self.lock:
+            if columns is None:
+                self.rows.pop(key, None)
+            else:
+                row = self.rows.get(key, {})
+                for column in columns:
+                    row.pop(column, None)
+
+    def _slice(self, key, column_start, column_finish, column_reversed):
+        row = self.rows.get(key)
+        if not row:
+            return [], row
+
+        names = sorted(row, key=_column_sort_key, reverse=column_reversed)
+        if column_start:
+            start = _column_sort_key(column_start)
+            if column_reversed:
+                names = [n for n in names if _column_sort_key(n) <= start]
+            else:
+                names = [n for n in names if _column_sort_key(n) >= start]
+        if column_finish:
+            finish = _column_sort_key(column_finish)
+            if column_reversed:
+                names = [n for n in names if _column_sort_key(n) >= finish]
+            else:
+                names = [n for n in names if _column_sort_key(n) <= finish]
+        return names, row
+
+    def insert(self, key, columns, ttl=None, timestamp=None,
+               write_consistency_level=None):
+        _count_call("%s.insert" % self.name)
+        self._insert(key, columns)
+
+    def add(self, key, column, value=1, write_consistency_level=None):
+        _count_call("%s.add" % self.name)
+        with self.lock:
+            row = self.rows.setdefault(key, {})
+            row[column] = row.get(column, 0) + value
+
+    def remove(self, key, columns=None, write_consistency_level=None):
+        _count_call("%s.remove" % self.name)
+        self._remove(key, columns)
+
+    def get(self, key, columns=None, column_start="", column_finish="",
+            column_count=100, column_reversed=False, include_timestamp=False,
+            read_consistency_level=None):
+        _count_call("%s.get" % self.name)
+
+        if columns is not None:
+            row = self.rows.get(key, {})
+            names = [name for name in columns if name in row]
+        else:
+            names, row = self._slice(key, column_start, column_finish,
+                                     column_reversed)
+            names = names[:column_count]
+
+        if not names:
+            raise NotFoundException()
+
+        if include_timestamp:
+            return collections.OrderedDict((n, (row[n], 0)) for n in names)
+        return collections.OrderedDict((n, row[n]) for n in names)
+
+    def xget(self, key, column_start="", column_finish="", buffer_size=None,
+             include_timestamp=False, read_consistency_level=None):
+        _count_call("%s.xget" % self.name)
+        names, row = self._slice(key, column_start, column_finish, False)
+        for name in names:
+            if include_timestamp:
+                yield name, (row[name], 0)
+            else:
+                yield name, row[name]
+
+    def multiget(self, keys, columns=None, read_consistency_level=None):
+        _count_call("%s.multiget" % self.name)
+
+        results = collections.OrderedDict()
+        for key in keys:
+            row = self.rows.get(key, {})
+            if columns is not None:
+                names = [name for name in columns if name in row]
+            else:
+                names = sorted(row, key=_column_sort_key)
+            if names:
+                results[key] = collections.OrderedDict(
+                    (name, row[name]) for name in names)
+        return results
+
+    def get_count(self, key, read_consistency_level=None):
+        _count_call("%s.get_count" % self.name)
+        return len(self.rows.get(key, ()))
+
+    def get_range(self, column_count=100, filter_empty=True,
+                  read_consistency_level=None, buffer_size=None):
+        _count_call("%s.get_range" % self.name)
+        for key in sorted(self.rows):
+            row = self.rows[key]
+            if not row and filter_empty:
+                continue
+            names = sorted(row, key=_column_sort_key)[:column_count]
+            yield key, collections.OrderedDict((n, row[n]) for n in names)
+
+    def batch(self, queue_size=100, write_consistency_level=None):
+        return FakeBatch(self)
+
+
+class FakeViewQuery(object):
+    def __init__(self, cls, rowkeys, count, reverse):
+        self.cls = cls
+        self.rowkeys = rowkeys
+        self.column_start = None
+        self.column_reversed = not reverse
+        self._limit = count
+
+    def _after(self, thing):
+        self.column_start = thing._id if thing else None
+
+    def _reverse(self):
+        self.column_reversed = not self.column_reversed
+
+    def __iter__(self):
+        remaining = self._limit
+        for rowkey in self.rowkeys:
+            try:
+                columns = self.cls._cf.get(
+                    rowkey,
+                    column_start=self.column_start or "",
+                    column_count=remaining + 1,
+                    column_reversed=self.column_reversed,
+                )
+            except NotFoundException:
+                continue
+
+            for name, value in columns.iteritems():
+                if name == self.column_start:
+                    continue
+
+                yield self.cls._column_to_obj([{name: value}])[0]
+
+                remaining -= 1
+                if remaining <= 0:
+                    return
+
+
+class _ViewType(type):
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        cls._cf = FakeColumnFamily(name)
+
+
+class View(object):
+    __metaclass__ = _ViewType
+
+    def __init__(self, _id, columns):
+        self._id = _id
+        self._t = columns
+
+    @classmethod
+    def _set_values(cls, row_key, col_values, ttl=None):
+        cls._cf.insert(row_key, col_values)
+
+    @classmethod
+    def _byID(cls, row_key, properties=None):
+        try:
+            columns = cls._cf.get(row_key, columns=properties)
+        except NotFoundException:
+            if properties is None:
+                raise NotFound(row_key)
+            columns = {}
+        return cls(row_key, dict(columns))
+
+    @classmethod
+    def query(cls, rowkeys, count=1000, reverse=False):
+        return FakeViewQuery(cls, rowkeys, count, reverse)
+
+
+class Thing(object):
+    _defaults = {}
+    _things = {}
+    _things_lock = threading.Lock()
+
+    def __init__(self, _id=None, _partial=None, **props):
+        self.__dict__["_id"] = _id
+        self.__dict__["_t"] = props
+        self.__dict__["_committed"] = False
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        try:
+            return self._t[name]
+        except KeyError:
+            try:
+                return self._defaults[name]
+            except KeyError:
+                raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            self.__dict__[name] = value
+        else:
+            self._t[name] = value
+
+    def __setitem__(self, name, value):
+        self._t[name] = value
+
+    def __delitem__(self, name):
+        del self._t[name]
+
+    @property
+    def _date(self):
+        return self._t.get("date")
+
+    def _commit(self):
+        _count_call("%s.commit" % type(self).__name__)
+        key = (type(self).__name__, self._id)
+        with self._things_lock:
+            Thing._things.setdefault(key, {}).update(self._t)
+        self._committed = True
+
+    @classmethod
+    def _byID(cls, ids, return_dict=True):
+        _count_call("%s.byID" % cls.__name__)
+        ids, single = tup(ids, ret_is_single=True)
+
+        things = {}
+        for id in ids:
+            props = Thing._things.get((cls.__name__, id))
+            if props is not None:
+                thing = things[id] = cls(id, **dict(props))
+                thing._committed = True
+
+        # like tdb_cassandra, missing ids are only an error when fetching one
+        if single:
+            if not things:
+                raise NotFound(ids[0])
+            return things[ids[0]]
+        elif return_dict:
+            return things
+        return [things[id] for id in ids if id in things]
+
+
+class CL(object):
+    ONE = "ONE"
+    QUORUM = "QUORUM"
+    ANY = "ANY"
+
+
+# accounts
+class Account(object):
+    _accounts = {}
+
+    def __init__(self, id, name):
+        self._id = id
+        self._id36 = to36(id)
+        self._fullname = "t2_" + self._id36
+        self._deleted = False
+        self.name = name
+
+    @classmethod
+    def _register(cls, id, name):
+        cls._accounts[id] = account = cls(id, name)
+        return account
+
+    @classmethod
+    def _byID(cls, ids, data=False, return_dict=True):
+        _count_call("Account.byID")
+        single = not isinstance(ids, (list, tuple, set))
+        if single:
+            return cls._accounts[ids]
+
+        accounts = [cls._accounts[id] for id in ids if id in cls._accounts]
+        if return_dict:
+            return dict((account._id, account) for account in accounts)
+        return accounts
+
+
+# r2.lib.utils
+def tup(item, ret_is_single=False):
+    if isinstance(item, (list, tuple)):
+        return (item, False) if ret_is_single else item
+    return ([item], True) if ret_is_single else [item]
+
+
+def in_chunks(it, size=25):
+    chunk = []
+    for item in it:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def fuzz_activity(count):
+    return count
+
+
+def to36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    s = ""
+    while n:
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+    return s or "0"
+
+
+# r2.lib.websockets
+sent_broadcasts = []
+
+
+def send_broadcast(namespace, type, payload):
+    _count_call("websockets.send_broadcast")
+    sent_broadcasts.append((namespace, type, payload))
+
+
+def make_url(namespace, max_age):
+    return "wss://websockets.example.com%s" % namespace
+
+
+class Templated(object):
+    def __init__(self, **context):
+        self.__dict__.update(context)
+
+    def render(self, style=None):
+        return u""
+
+
+class Wrapped(object):
+    def __init__(self, thing):
+        self.__dict__["lookups"] = [thing]
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.lookups[0], name)
+
+    def render(self, style=None):
+        return u""
+
+
+class Reddit(Templated):
+    extra_stylesheets = []
+
+
+class QueryBuilder(object):
+    """Just enough of r2's QueryBuilder to pull a page of items through."""
+
+    def __init__(self, query, skip=False, reverse=False, num=None,
+                 count=0, **kwargs):
+        self.query = query
+        self.num = num
+
+    def wrap(self, item):
+        return Wrapped(item)
+
+    def keep_item(self, item):
+        return True
+
+    def wrap_items(self, items):
+        return [self.wrap(item) for item in items]
+
+    def fetch_more(self, last_item, num_have):
+        return list(itertools.islice(self.query, self.num))
+
+    def get_items(self):
+        items = [item for item in self.fetch_more(None, 0)
+                 if self.keep_item(item)]
+        return self.wrap_items(items)
+
+
+class Listing(object):
+    def __init__(self, builder):
+        self.builder = builder
+
+    def listing(self):
+        self.things = self.builder.get_items()
+        return self
+
+
+class Link(object):
+    @classmethod
+    def _by_url(cls, url, sr=None):
+        _count_call("Link.by_url")
+        raise NotFound(url)
+
+    @classmethod
+    def _byID(cls, ids, data=False, return_dict=True):
+        _count_call("Link.byID")
+        return {} if return_dict else []
+
+
+class Subreddit(object):
+    @classmethod
+    def _byID(cls, ids, data=False, return_dict=True):
+        _count_call("Subreddit.byID")
+        return {} if return_dict else []
+
+
+class HTTPAbort(Exception):
+    pass
+
+
+def abort(code, message=None):
+    raise HTTPAbort(code, message)
+
+
+class BaseController(object):
+    def __before__(self, *args, **kwargs):
+        pass
+
+    def __after__(self):
+        pass
+
+    def abort404(self):
+        abort(404)
+
+
+class RedditController(BaseController):
+    pass
+
+
+class FakeTimer(object):
+    def start(self):
+        pass
+
+    def intermediate(self, name):
+        pass
+
+    def stop(self, name="total"):
+        pass
+
+
+class FakeStats(object):
+    def get_timer(self, name, publish=True):
+        return FakeTimer()
+
+    def simple_event(self, event_name, delta=1, sample_rate=1.0):
+        pass
+
+
+class FakeRequest(Bag):
+    pass
+
+
+class FakeResponse(Bag):
+    def __init__(self):
+        Bag.__init__(self, headers={}, content_type=None, status_int=200)
+
+
+g = Bag()
+c = Bag()
+request = FakeRequest()
+response = FakeResponse()
+
+_LOCALE = Locale("en")
+_installed = False
+
+
+def reset_request(**attrs):
+    """Start a fresh "request" with an empty `c`."""
+    c.reset(locale=_LOCALE, lang="en", user=None,
+            user_is_loggedin=False, user_is_admin=False, **attrs)
+    request.reset(ip="127.0.0.1", user_agent="benchmark",
+                  environ={"extension": None}, headers={}, GET={},
+                  host="www.example.com")
+    response.reset(headers={}, content_type=None, status_int=200)
+
+
+def install():
+    """Install the fakes in sys.modules. Call before importing the plugin."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if package_root not in sys.path:
+        sys.path.insert(0, package_root)
+
+    # r2 serves the tracking pixel from its own static files
+    static_root = tempfile.mkdtemp(prefix="liveupdate-bench-")
+    os.makedirs(os.path.join(static_root, "public/static"))
+    with open(os.path.join(static_root, "public/static/pixel.png"), "wb") as f:
+        f.write("\x89PNG\r\n\x1a\n" + "\x00" * 60)
+
+    log = logging.getLogger("liveupdate-bench")
+    log.addHandler(logging.NullHandler())
+
+    g.reset(
+        cache=FakeCache(),
+        log=log,
+        tz=pytz.UTC,
+        paths={"root": static_root},
+        media_domain="media.example.com",
+        liveupdate_pixel_domain="pixel.example.com",
+        liveupdate_visitor_counter="columns",
+        liveupdate_pixel_flush_size=1000,
+        liveupdate_pixel_flush_interval=0,
+        liveupdate_broadcast_window=0,
+        liveupdate_pixel_max_pending=100000,
+        liveupdate_snapshot_store="",
+        liveupdate_snapshot_path="",
+        liveupdate_stats_sample_rate=0,
+        make_lock=FakeLock,
+        stats=FakeStats(),
+    )
+    reset_request()
+
+    _module("pylons", g=g, c=c, request=request, response=response)
+    _module("pylons.i18n",
+            _=lambda s: s,
+            N_=lambda s: s,
+            ungettext=lambda one, many, n: one if n == 1 else many)
+    _module("pylons.controllers")
+    _module("pylons.controllers.util", abort=abort)
+
+    _module("pycassa", NotFoundException=NotFoundException)
+    _module("pycassa.util", convert_uuid_to_time=convert_uuid_to_time)
+    _module("pycassa.system_manager",
+            COUNTER_COLUMN_TYPE="CounterColumnType",
+            LONG_TYPE="LongType",
+            TIME_UUID_TYPE="TimeUUIDType",
+            UTF8_TYPE="UTF8Type")
+
+    _module("r2")
+    _module("r2.lib")
+    _module("r2.lib.db")
+    _module("r2.lib.db.tdb_cassandra",
+            View=View,
+            Thing=Thing,
+            CL=CL,
+            NotFound=NotFound,
+            NotFoundException=NotFoundException,
+            TRANSIENT_EXCEPTIONS=(TransientError,),
+            ASCII_TYPE="AsciiType",
+            UTF8_TYPE="UTF8Type")
+    _module("r2.lib.filters",
+            safemarkdown=lambda text, wrap=True: u"<p>%s</p>" % text,
+            spaceCompress=lambda html: html,
+            SC_OFF="<!-- SC_OFF -->",
+            SC_ON="<!-- SC_ON -->",
+            MD_START='<div class="md">',
+            MD_END="</div>")
+    _module("r2.lib.utils",
+            tup=tup,
+            in_chunks=in_chunks,
+            fuzz_activity=fuzz_activity,
+            to36=to36)
+    _module("r2.lib.websockets",
+            send_broadcast=send_broadcast,
+            make_url=make_url)
+    _module("r2.lib.lock", TimeoutExpired=TimeoutExpired)
+    _module("r2.lib.amqp", worker=Bag(join=lambda: None))
+    _module("r2.lib.wrapped", Templated=Templated, Wrapped=Wrapped)
+    _module("r2.lib.pages", Reddit=Reddit)
+    _module("r2.lib.base", BaseController=BaseController, abort=abort)
+    _module("r2.controllers")
+    _module("r2.controllers.reddit_base", RedditController=RedditController)
+    _module("r2.models",
+            Account=Account,
+            Link=Link,
+            Listing=Listing,
+            NotFound=NotFound,
+            QueryBuilder=QueryBuilder,
+            Subreddit=Subreddit)
+
+    for name in ("r2.config", "r2.config.routing", "r2.config.templates",
+                 "r2.lib.configparse", "r2.lib.errors",
+                 "r2.lib.hooks", "r2.lib.js", "r2.lib.jsontemplates",
+                 "r2.lib.media", "r2.lib.memoize", "r2.lib.menus",
+                 "r2.lib.plugin", "r2.lib.strings",
+                 "r2.lib.template_helpers", "r2.lib.validator"):
+        _module(name)
+
+
+def reset_backends():
+    """Empty every fake data store and forget the calls made to them."""
+    g.cache.data.clear()
+    Thing._things.clear()
+    tagged_backend_calls.clear()
+    for cf in _all_column_families():
+        cf.rows.clear()
+    backend_calls.clear()
+    del sent_broadcasts[:]
+
+
+def _all_column_families():
+    pending = [View]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if cls is not View:
+            yield cls._cf
+
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+"""Simulate traffic to live events, or replay it from an access log.
+
+Requests are run through the real controllers and models against the
+in-memory fakes in fakes.py, one at a time and as fast as possible, like a
+single app process would. How long that takes compared to the period being
+simulated is how much of a core the traffic needs; anything over 1.0 would
+saturate a single-process node.
+
+    python benchmarks/loadsim.py simulate --events 1 --viewers 20000
+    python benchmarks/loadsim.py simulate --viewers 1000 --ramp
+    python benchmarks/loadsim.py replay /var/log/nginx/access.log
+
+Simulated viewers behave like liveupdate.js: they load the event page, fetch
+the visitor pixel straight away and then every 5-10 minutes, and some of
+them scroll down and load a few more pages of updates. Viewers leave after
+an exponentially distributed session and someone new takes their place.
+Reporters post at a steady average rate and the activity job runs once a
+minute. Replayed logs must be in the common or combined log format.
+
+The fakes don't render templates, so the timings cover the plugin's own work
+and its backend round trips but not the cost of turning pages into HTML.
+
+"""
+
+import argparse
+import calendar
+import collections
+import datetime
+import heapq
+import itertools
+import random
+import re
+import time
+import urlparse
+import uuid
+
+import fakes
+fakes.install()
+
+
+# from liveupdate.js: each pixel is fetched between half and all of this
+# many seconds after the last one
+PIXEL_INTERVAL = 10 * 60
+PAGE_SIZE = 25
+SEED_UPDATES = 200
+
+# endpoints that run as separate jobs rather than on app servers
+JOB_ENDPOINTS = ("update_activity",)
+
+
+Request = collections.namedtuple("Request", "time endpoint event_id params")
+
+
+def _pixel_delay(rng, interval):
+    return interval - interval * rng.random() / 2
+
+
+def _viewers(event_ids, num_viewers, duration, args, rng):
+    """Yield the requests from every viewer's seat in every event, in order.
+
+    Each seat starts out occupied by someone who loaded the page before the
+    run started, and each time its viewer leaves a new one arrives. Seats are
+    kept as small lists on a heap, ordered by when they next do something,
+    so even a million of them don't take up much memory.
+
+    """
+    visitor_ids = itertools.count()
+    seq = itertools.count()
+
+    # [event id, visitor, next pixel, session end, pending requests]
+    seats = []
+    for event_id in event_ids:
+        for i in xrange(num_viewers):
+            seat = [event_id, next(visitor_ids),
+                    rng.uniform(0, args.pixel_interval),
+                    rng.expovariate(1. / args.session_length), []]
+            seats.append((min(seat[2], seat[3]), next(seq), seat))
+    heapq.heapify(seats)
+
+    while seats:
+        now, _, seat = heapq.heappop(seats)
+        event_id, visitor, next_pixel, session_end, pending = seat
+
+        if pending:
+            yield pending.pop(0)
+        elif next_pixel < session_end:
+            yield Request(now, "pixel", event_id, {"visitor": visitor})
+            seat[2] += _pixel_delay(rng, args.pixel_interval)
+        else:
+            # the viewer's left and someone new loads the page
+            seat[1] = visitor = next(visitor_ids)
+            yield Request(now, "listing", event_id, {})
+            pending.append(Request(now, "pixel", event_id,
+                                   {"visitor": visitor}))
+
+            if rng.random() < args.scroll_probability:
+                for page in xrange(1, rng.randint(1, 3) + 1):
+                    now += rng.uniform(5, 30)
+                    pending.append(Request(now, "listing", event_id,
+                                           {"page": page}))
+
+            seat[2] = now + _pixel_delay(rng, args.pixel_interval)
+            seat[3] = now + rng.expovariate(1. / args.session_length)
+
+        if pending:
+            next_time = pending[0].time
+        else:
+            next_time = min(seat[2], seat[3])
+
+        if next_time < duration:
+            heapq.heappush(seats, (next_time, next(seq), seat))
+
+
+def _reporters(event_id, duration, args, rng):
+    now = 0
+    while True:
+        now += rng.expovariate(args.posts_per_minute / 60.)
+        if now >= duration:
+            return
+        yield Request(now, "update", event_id, {})
+
+
+def _activity_job(duration, interval):
+    for now in itertools.count(interval, interval):
+        if now >= duration:
+            return
+        yield Request(now, "update_activity", None, {})
+
+
+def simulate(args, num_viewers):
+    rng = random.Random(args.seed)
+    event_ids = ["event%d" % i for i in xrange(args.events)]
+
+    streams = [
+        _viewers(event_ids, num_viewers, args.duration, args, rng),
+        _activity_job(args.duration, args.activity_interval),
+    ]
+    for event_id in event_ids:
+        streams.append(_reporters(event_id, args.duration, args, rng))
+
+    return event_ids, heapq.merge(*streams)
+
+
+_LOG_LINE = re.compile(r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+                       r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" ')
+_LIVE_PATH = re.compile(r"^(?:/api)?/live/(?P<event>[^/.?]+)"
+                        r"(?:/(?P<action>[a-z_]+))?/?(?:\.(?P<ext>\w+))?$")
+_RENDER_STYLES = {None: "html", "json": "json", "rss": "xml", "xml": "xml"}
+
+
+def _parse_log_time(value):
+    # strptime can't do the utc offset, but times are only used relative
+    # to each other so it can be dropped
+    timestamp = datetime.datetime.strptime(value.split()[0],
+                                           "%d/%b/%Y:%H:%M:%S")
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def _parse_log_line(line):
+    match = _LOG_LINE.match(line)
+    if not match:
+        return None
+
+    parsed = urlparse.urlparse(match.group("path"))
+    path_match = _LIVE_PATH.match(parsed.path)
+    if not path_match:
+        return None
+
+    event_id = path_match.group("event")
+    action = path_match.group("action")
+    query = urlparse.parse_qs(parsed.query)
+    params = {}
+
+    if action == "pixel":
+        endpoint = "pixel"
+        params["visitor"] = match.group("ip")
+    elif action in (None, "embed"):
+        endpoint = "listing"
+        params["render_style"] = _RENDER_STYLES.get(path_match.group("ext"),
+                                                    "html")
+        params["is_embed"] = action == "embed"
+        if "after" in query:
+            # the logged ids won't exist here, so turn them into the page
+            # that far down the stream
+            count = int(query.get("count", [PAGE_SIZE])[0] or PAGE_SIZE)
+            params["page"] = max(1, count // PAGE_SIZE)
+    elif action == "update" and match.group("method") == "POST":
+        endpoint = "update"
+    elif action in ("oembed", "messages", "updates_since"):
+        endpoint = action
+    else:
+        return None
+
+    return Request(_parse_log_time(match.group("time")), endpoint, event_id,
+                   params)
+
+
+def replay(path):
+    requests = []
+    skipped = 0
+    with open(path) as f:
+        for line in f:
+            request = _parse_log_line(line)
+            if request:
+                requests.append(request)
+            else:
+                skipped += 1
+
+    if not requests:
+        raise SystemExit("no live update requests found in %s" % path)
+
+    requests.sort(key=lambda request: request.time)
+    start = requests[0].time
+    requests = [request._replace(time=request.time - start)
+                for request in requests]
+    event_ids = sorted(set(request.event_id for request in requests))
+    duration = max(requests[-1].time, 1)
+    return event_ids, requests, duration, skipped
+
+
+class _Form(fakes.Stub):
+    def has_errors(self, *args, **kwargs):
+        return False
+
+
+class Node(object):
+    """An app process serving requests from the fakes."""
+
+    def __init__(self):
+        from reddit_liveupdate.controllers import (
+            LiveUpdateController,
+            LiveUpdatePixelController,
+        )
+
+        self.controller = LiveUpdateController()
+        self.pixel_controller = LiveUpdatePixelController()
+        self.reporter = fakes.Account._register(1, "reporter")
+
+        # newest first, to work out what "load more" asks for
+        self.update_ids = {}
+
+    def add_events(self, event_ids, num_updates):
+        from reddit_liveupdate.models import (
+            LiveUpdate,
+            LiveUpdateEvent,
+            LiveUpdateStream,
+        )
+
+        for event_id in event_ids:
+            event = LiveUpdateEvent.new(event_id, title="event " + event_id)
+            event.add_reporter(self.reporter)
+
+            ids = self.update_ids[event_id] = []
+            for i in xrange(num_updates):
+                update = LiveUpdate(data={
+                    "author_id": self.reporter._id,
+                    "body": "seeded update number %d" % i,
+                })
+                LiveUpdateStream.add_update(event, update)
+                ids.insert(0, update._id)
+
+            event.mark_modified(new_update=update)
+            event._commit()
+
+    def handle(self, request):
+        """Serve the request and return how long it took."""
+        handler = getattr(self, "_handle_" + request.endpoint)
+
+        fakes.reset_request()
+        with fakes.tag_backend_calls(request.endpoint):
+            start = time.time()
+            try:
+                handler(request)
+            except fakes.HTTPAbort:
+                pass
+            return time.time() - start
+
+    def _before(self, request, action, **routes):
+        routes["action"] = action
+        fakes.request.environ["pylons.routes_dict"] = routes
+        self.controller.__before__(request.event_id)
+
+    def _handle_pixel(self, request):
+        fakes.request.environ["extension"] = "png"
+        fakes.request.ip = str(request.params["visitor"])
+        self.pixel_controller.GET_pixel(request.event_id)
+
+    def _handle_listing(self, request):
+        page = request.params.get("page", 0)
+        is_embed = request.params.get("is_embed", False)
+        fakes.c.render_style = request.params.get("render_style", "html")
+
+        after = None
+        count = 0
+        ids = self.update_ids.get(request.event_id)
+        if page and ids:
+            count = min(page * PAGE_SIZE, len(ids))
+            after = ids[count - 1]
+            fakes.request.GET = {
+                "bare": "y",
+                "after": "LiveUpdate_%s" % after,
+                "count": str(count),
+            }
+
+        self._before(request, "listing", is_embed=is_embed)
+        self.controller.GET_listing(num=PAGE_SIZE, after=after, before=None,
+                                    count=count, is_embed=is_embed)
+
+    def _handle_update(self, request):
+        fakes.c.user = self.reporter
+        fakes.c.user_is_loggedin = True
+        self._before(request, "update")
+        self.controller.POST_update(_Form(), fakes.Stub(),
+                                    text="a new update from the reporter")
+
+        update_id = uuid.UUID(fakes.c.liveupdate_event.last_modified_id)
+        self.update_ids.setdefault(request.event_id, []).insert(0, update_id)
+
+    def _handle_oembed(self, request):
+        self._before(request, "oembed")
+        self.controller.GET_oembed()
+
+    def _handle_messages(self, request):
+        self._before(request, "messages")
+        self.controller.GET_messages(after=0)
+
+    def _handle_updates_since(self, request):
+        self._before(request, "updates_since")
+        ids = self.update_ids.get(request.event_id) or [None]
+        self.controller.GET_updates_since(since=ids[-1], num=100)
+
+    def _handle_update_activity(self, request):
+        from reddit_liveupdate import activity
+        activity.update_activity()
+
+
+def run(requests):
+    latencies = collections.defaultdict(list)
+    node = Node()
+    node.add_events(requests.event_ids, requests.seed_updates)
+    fakes.backend_calls.clear()
+    fakes.tagged_backend_calls.clear()
+
+    for request in requests:
+        latencies[request.endpoint].append(node.handle(request))
+        del fakes.sent_broadcasts[:]
+    return latencies
+
+
+class Workload(object):
+    def __init__(self, event_ids, requests, duration, seed_updates):
+        self.event_ids = event_ids
+        self.requests = requests
+        self.duration = duration
+        self.seed_updates = seed_updates
+
+    def __iter__(self):
+        return iter(self.requests)
+
+
+def _percentile(sorted_values, percent):
+    index = int(round(percent / 100. * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _ms(seconds):
+    return "%.2f" % (seconds * 1000)
+
+
+def _app_load(latencies, duration):
+    busy = sum(sum(values) for endpoint, values in latencies.iteritems()
+               if endpoint not in JOB_ENDPOINTS)
+    return busy / duration
+
+
+def report(latencies, duration):
+    print
+    print "%-16s %9s %10s %10s %8s %8s %8s %8s" % (
+        "endpoint", "requests", "offered/s", "capacity/s",
+        "p50 ms", "p90 ms", "p99 ms", "max ms")
+
+    for endpoint, values in sorted(latencies.iteritems()):
+        values = sorted(values)
+        total = sum(values)
+        print "%-16s %9d %10.2f %10.0f %8s %8s %8s %8s" % (
+            endpoint,
+            len(values),
+            float(len(values)) / duration,
+            len(values) / total if total else 0,
+            _ms(_percentile(values, 50)),
+            _ms(_percentile(values, 90)),
+            _ms(_percentile(values, 99)),
+            _ms(values[-1]),
+        )
+
+    print
+    print "backend calls per request:"
+    by_endpoint = collections.defaultdict(list)
+    for (endpoint, call), count in fakes.tagged_backend_calls.iteritems():
+        by_endpoint[endpoint].append((call, count))
+    for endpoint, calls in sorted(by_endpoint.iteritems()):
+        num_requests = len(latencies.get(endpoint, ())) or 1
+        print "  %s" % endpoint
+        for call, count in sorted(calls):
+            print "    %-40s %10.2f" % (call, float(count) / num_requests)
+
+    print
+    print "simulated %ds of traffic; app servers need %.3f cores" % (
+        duration, _app_load(latencies, duration))
+
+
+def _simulated_workload(args, num_viewers):
+    event_ids, requests = simulate(args, num_viewers)
+    return Workload(event_ids, requests, args.duration, args.seed_updates)
+
+
+def ramp(args):
+    """Double the viewers until the events need more than --cores cores."""
+    num_viewers = args.viewers
+    while num_viewers <= args.max_viewers:
+        fakes.reset_backends()
+        latencies = run(_simulated_workload(args, num_viewers))
+        load = _app_load(latencies, args.duration)
+        print "%8d viewers per event: %.3f cores" % (num_viewers, load)
+
+        if load >= args.cores:
+            report(latencies, args.duration)
+            return
+        num_viewers *= 2
+
+    print "not saturated by %d viewers per event" % args.max_viewers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--seed-updates", type=int, default=SEED_UPDATES,
+                        help="updates to put in each event beforehand")
+    parser.add_argument("--pixel-flush-interval", type=float, default=0,
+                        help="liveupdate_pixel_flush_interval to run with")
+    parser.add_argument("--visitor-counter", default="columns",
+                        choices=["columns", "hll"])
+    subparsers = parser.add_subparsers(dest="command")
+
+    sim = subparsers.add_parser("simulate")
+    sim.add_argument("--events", type=int, default=1)
+    sim.add_argument("--viewers", type=int, default=5000,
+                     help="concurrent viewers per event")
+    sim.add_argument("--duration", type=int, default=600,
+                     help="seconds of traffic to simulate")
+    sim.add_argument("--session-length", type=float, default=15 * 60,
+                     help="mean seconds a viewer stays on the page")
+    sim.add_argument("--scroll-probability", type=float, default=0.2,
+                     help="chance a new viewer loads more updates")
+    sim.add_argument("--posts-per-minute", type=float, default=2,
+                     help="reporter posts per minute in each event")
+    sim.add_argument("--activity-interval", type=int, default=60)
+    sim.add_argument("--pixel-interval", type=float, default=PIXEL_INTERVAL)
+    sim.add_argument("--seed", type=int, default=0)
+    sim.add_argument("--ramp", action="store_true",
+                     help="keep doubling the viewers until saturated")
+    sim.add_argument("--cores", type=float, default=1.0,
+                     help="cores per node when ramping")
+    sim.add_argument("--max-viewers", type=int, default=2000000,
+                     help="give up ramping past this many viewers")
+
+    rep = subparsers.add_parser("replay")
+    rep.add_argument("logfile")
+
+    args = parser.parse_args()
+    fakes.g.liveupdate_pixel_flush_interval = args.pixel_flush_interval
+    fakes.g.liveupdate_visitor_counter = args.visitor_counter
+
+    if args.command == "replay":
+        event_ids, requests, duration, skipped = replay(args.logfile)
+        print "replaying %d requests (%d lines skipped)" % (len(requests),
+                                                          skipped)
+        workload = Workload(event_ids, requests, duration, args.seed_updates)
+    elif args.ramp:
+        ramp(args)
+        return
+    else:
+        workload = _simulated_workload(args, args.viewers)
+
+    start = time.time()
+    latencies = run(workload)
+    print "ran in %.1fs" % (time.time() - start)
+    report(latencies, workload.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Run the liveupdate microbenchmarks.
+
+Everything runs offline against the in-memory fakes in fakes.py. For each
+benchmark this reports the best and mean time per call and the number of
+garbage-collector tracked objects a call leaves behind (which includes
+anything it stored in the fakes). That's what a call retains, not how much
+it allocates: Python 2 has no count of allocations to read, and the gc's
+generation 0 count goes back down as objects are freed, so it measures the
+same thing.
+
+    python benchmarks/run.py                      # run everything
+    python benchmarks/run.py -k pixel             # just the matching ones
+    python benchmarks/run.py --save before        # save baselines/before.json
+    python benchmarks/run.py --compare before     # compare against it
+
+When comparing, anything slower than the baseline by more than --threshold
+(10% by default) is flagged and the exit status is 1.
+
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+import fakes
+fakes.install()
+
+import cases
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "baselines")
+
+# keep calling a benchmark until a single measurement takes at least this
+# long, then take the best of REPEATS such measurements
+MIN_MEASUREMENT_TIME = 0.2
+REPEATS = 5
+
+
+def _calibrate(fn):
+    loops = 1
+    while True:
+        start = time.time()
+        for i in xrange(loops):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= MIN_MEASUREMENT_TIME:
+            return loops, elapsed / loops
+        loops *= 10
+
+
+def _count_retained(fn):
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        fn()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    return after - before
+
+
+def measure(fn, repeats=REPEATS):
+    loops, first = _calibrate(fn)
+
+    timings = [first]
+    for i in xrange(repeats - 1):
+        start = time.time()
+        for j in xrange(loops):
+            fn()
+        timings.append((time.time() - start) / loops)
+
+    return {
+        "loops": loops,
+        "best": min(timings),
+        "mean": sum(timings) / len(timings),
+        "retained": _count_retained(fn),
+    }
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return "%.1fus" % (seconds * 1e6)
+    elif seconds < 1:
+        return "%.2fms" % (seconds * 1e3)
+    return "%.2fs" % seconds
+
+
+def run_benchmarks(pattern, scale, repeats):
+    results = {}
+    for name, setup in cases.BENCHMARKS:
+        if pattern and pattern.lower() not in name.lower():
+            continue
+
+        fakes.reset_backends()
+        fn = setup(scale)
+        results[name] = result = measure(fn, repeats)
+
+        print "%-45s %10s %10s %8d objs" % (
+            name, format_time(result["best"]), format_time(result["mean"]),
+            result["retained"])
+    return results
+
+
+def _baseline_path(name):
+    return os.path.join(BASELINE_DIR, name + ".json")
+
+
+def save_baseline(name, results, scale):
+    if not os.path.isdir(BASELINE_DIR):
+        os.makedirs(BASELINE_DIR)
+
+    with open(_baseline_path(name), "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "scale": scale,
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    print "saved baseline to %s" % _baseline_path(name)
+
+
+def compare_baseline(name, results, scale, threshold):
+    with open(_baseline_path(name)) as f:
+        baseline = json.load(f)
+
+    if baseline["scale"] != scale:
+        print "warning: baseline was run with --scale %s" % baseline["scale"]
+
+    print
+    print "%-45s %10s %10s %8s" % ("compared to " + name, "before", "after",
+                                   "change")
+
+    regressions = 0
+    for bench_name, result in sorted(results.iteritems()):
+        try:
+            before = baseline["results"][bench_name]["best"]
+        except KeyError:
+            continue
+
+        after = result["best"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        print "%-45s %10s %10s %+7.1f%%%s" % (
+            bench_name, format_time(before), format_time(after),
+            change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-k", dest="pattern",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale the number of events and visitors")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--save", metavar="NAME",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME",
+                        help="compare the results against a baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    print "%-45s %10s %10s %13s" % ("benchmark", "best", "mean", "retained")
+    results = run_benchmarks(args.pattern, args.scale, args.repeats)
+
+    if args.save:
+        save_baseline(args.save, results, args.scale)
+
+    if args.compare:
+        regressions = compare_baseline(args.compare, results, args.scale,
+                                       args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,20 @@ class LiveUpdate(Plugin):
     config = {
         ConfigValue.str: [
             "liveupdate_pixel_domain",
+            "liveupdate_visitor_counter",
+            "liveupdate_snapshot_store",
+            "liveupdate_snapshot_path",
+        ],
+
+        ConfigValue.int: [
+            "liveupdate_pixel_flush_size",
+            "liveupdate_pixel_max_pending",
+        ],
+
+        ConfigValue.float: [
+            "liveupdate_broadcast_window",
+            "liveupdate_pixel_flush_interval",
+            "liveupdate_stats_sample_rate",
         ],
     }
 
@@ -1,59 +1,338 @@
+import collections
+import signal
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 from pylons import g
 
-from r2.lib import amqp, websockets, utils
+from r2.lib import amqp, utils
 from r2.lib.db import tdb_cassandra
+from r2.lib.lock import TimeoutExpired
 
+from reddit_liveupdate import broadcast, instrumentation
 from reddit_liveupdate.models import (
     ActiveVisitorsByLiveUpdateEvent,
+    LiveUpdateActiveEventsIndex,
     LiveUpdateEvent,
     LiveUpdateActivityHistoryByEvent,
 )
 
 
-ACTIVITY_FUZZING_THRESHOLD = 100
+# how many events to have in flight at once and how many to write per batch
+ACTIVITY_WORKERS = 8
+ACTIVITY_BATCH_SIZE = 100
 
+# how long (in seconds) to wait on a batch of events before giving up on the
+# ones that haven't finished
+ACTIVITY_BATCH_TIMEOUT = 10
 
-def update_activity():
-    event_ids = ActiveVisitorsByLiveUpdateEvent._cf.get_range(
-        column_count=1, filter_empty=False)
+# the cron job and the daemon each hold this lock while they work so only one
+# process writes activity at a time. it expires after ACTIVITY_LOCK_TIME
+# seconds, which is far longer than a run takes, in case its holder dies.
+ACTIVITY_LOCK_TIME = 15 * 60
 
-    for event_id, is_active in event_ids:
-        count = 0
+# when running as a daemon: how often (in seconds) to look for events that
+# are due, how often to rescan for new events, and how long to wait before
+# refreshing an event with at least so many visitors. quieter events fall
+# through to the last interval.
+ACTIVITY_DAEMON_TICK = 5
+ACTIVITY_SCAN_INTERVAL = 60
+ACTIVITY_INTERVALS = [
+    (10000, 10),
+    (1000, 20),
+    (100, 30),
+    (1, 60),
+]
+ACTIVITY_IDLE_INTERVAL = 5 * 60
+
+# when running as a daemon, how long (in seconds) to wait before retrying an
+# event that failed the first time. this doubles with each further failure,
+# up to ACTIVITY_IDLE_INTERVAL.
+ACTIVITY_RETRY_DELAY = 10
+
+
+def _update_event_activity(event_id):
+    count = ActiveVisitorsByLiveUpdateEvent.get_count(event_id)
+
+    try:
+        LiveUpdateEvent.update_activity(event_id, count)
+    except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+        g.log.warning("Failed to update event activity for %r: %s",
+                      event_id, e)
+
+    return count
 
-        if is_active:
-            try:
-                count = ActiveVisitorsByLiveUpdateEvent.get_count(event_id)
-            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-                g.log.warning("Failed to fetch activity count for %r: %s",
-                              event_id, e)
-                return
 
+def _update_activity_batch(pool, event_ids, totals, timer):
+    """Count, record and broadcast activity for some events.
+
+    Events whose count has dropped to zero get that broadcast one last time
+    and are then removed from the active events index.
+
+    Returns a dict of the events that were counted and their counts, and
+    whether any worker had to be abandoned mid-request.
+
+    """
+    abandoned_workers = False
+
+    totals["events_scanned"] += len(event_ids)
+
+    results = [(event_id, pool.apply_async(_update_event_activity,
+                                           (event_id,)))
+               for event_id in event_ids]
+
+    # one deadline for the whole batch: if the workers are stuck, waiting on
+    # each event in turn would take the timeout times the batch size
+    deadline = time.time() + ACTIVITY_BATCH_TIMEOUT
+
+    activity = {}
+    for event_id, result in results:
         try:
-            LiveUpdateEvent.update_activity(event_id, count)
+            activity[event_id] = result.get(
+                timeout=max(0, deadline - time.time()))
+        except TimeoutError:
+            g.log.warning("Timed out fetching activity for %r", event_id)
+            abandoned_workers = True
+            totals["errors"] += 1
         except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-            g.log.warning("Failed to update event activity for %r: %s",
+            g.log.warning("Failed to fetch activity count for %r: %s",
                           event_id, e)
+            totals["errors"] += 1
+    timer.intermediate("count")
+
+    try:
+        LiveUpdateActivityHistoryByEvent.record_activity_batch(activity)
+    except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+        g.log.warning("Failed to update activity history: %s", e)
+        totals["errors"] += 1
+    timer.intermediate("history_write")
+
+    sent = broadcast.send_activity_broadcasts(activity)
+    totals["broadcasts_skipped"] += len(activity) - sent
+    timer.intermediate("websocket_send")
 
+    idle_event_ids = [event_id for event_id, count in activity.iteritems()
+                      if count == 0]
+    if idle_event_ids:
         try:
-            LiveUpdateActivityHistoryByEvent.record_activity(event_id, count)
+            LiveUpdateActiveEventsIndex.remove_events(idle_event_ids)
         except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-            g.log.warning("Failed to update activity history for %r: %s",
-                          event_id, e)
+            g.log.warning("Failed to remove idle events: %s", e)
+            totals["errors"] += 1
+        else:
+            totals["events_dropped"] += len(idle_event_ids)
+    timer.intermediate("index_write")
+
+    return activity, abandoned_workers
+
 
-        is_fuzzed = False
-        if count < ACTIVITY_FUZZING_THRESHOLD:
-            count = utils.fuzz_activity(count)
-            is_fuzzed = True
+def _close_pool(pool, abandoned_workers):
+    pool.close()
 
-        websockets.send_broadcast(
-            "/live/" + event_id,
-            type="activity",
-            payload={
-                "count": count,
-                "fuzzed": is_fuzzed,
-            },
-        )
+    # the pool's threads are daemonic, so if one is stuck on a request
+    # we timed out on we can leave it behind rather than wait forever.
+    if not abandoned_workers:
+        pool.join()
 
+
+def _finish_run(timer, totals):
     # ensure that all the amqp messages we've put on the worker's queue are
-    # sent before we allow this script to exit.
+    # sent before we allow this script to exit (or the next run to start).
     amqp.worker.join()
+    timer.intermediate("websocket_flush")
+
+    for name in ("events_scanned", "events_dropped", "broadcasts_skipped",
+                 "errors"):
+        instrumentation.count("activity." + name, totals[name])
+    timer.stop()
+
+
+def _activity_lock():
+    # don't wait: whoever holds it is already doing the work
+    return g.make_lock("liveupdate_activity", "liveupdate_activity_lock",
+                       time=ACTIVITY_LOCK_TIME, timeout=0, verbose=False)
+
+
+def update_activity():
+    try:
+        lock = _activity_lock()
+        lock.acquire()
+    except TimeoutExpired:
+        g.log.warning("Liveupdate activity is already being updated, "
+                      "skipping this run")
+        return
+
+    try:
+        _update_all_activity()
+    finally:
+        lock.release()
+
+
+def _update_all_activity():
+    # there's only one run a minute, so every run is timed
+    timer = instrumentation.get_timer("activity", sample_rate=1)
+    totals = collections.Counter()
+    event_ids = LiveUpdateActiveEventsIndex.get_event_ids()
+
+    pool = ThreadPool(ACTIVITY_WORKERS)
+    abandoned_workers = False
+
+    try:
+        for chunk in utils.in_chunks(event_ids, size=ACTIVITY_BATCH_SIZE):
+            activity, abandoned = _update_activity_batch(
+                pool, chunk, totals, timer)
+            abandoned_workers |= abandoned
+    finally:
+        _close_pool(pool, abandoned_workers)
+
+    _finish_run(timer, totals)
+
+
+def _refresh_interval(count):
+    for min_count, interval in ACTIVITY_INTERVALS:
+        if count >= min_count:
+            return interval
+    return ACTIVITY_IDLE_INTERVAL
+
+
+class ActivityScheduler(object):
+    """Decide when each event's activity next needs refreshing.
+
+    Events with more visitors are refreshed more often (see
+    ACTIVITY_INTERVALS), except for completed events, whose pages have no
+    websocket to hear the broadcasts, and ids that aren't events at all.
+    Those are refreshed at ACTIVITY_IDLE_INTERVAL whatever their count.
+    Events that fail are retried with an increasing delay.
+
+    The set of events comes from periodically rereading the active events
+    index; events that have dropped out of it are forgotten and newly active
+    ones are refreshed right away.
+
+    """
+
+    def __init__(self):
+        # event_id -> next refresh time
+        self.events = {}
+        self.quiet_events = set()
+        # event_id -> number of failures in a row
+        self.failures = {}
+        self.next_scan = 0
+
+    def scan(self, now):
+        if now < self.next_scan:
+            return
+        self.next_scan = now + ACTIVITY_SCAN_INTERVAL
+
+        event_ids = LiveUpdateActiveEventsIndex.get_event_ids()
+
+        events = {}
+        for chunk in utils.in_chunks(event_ids, size=ACTIVITY_BATCH_SIZE):
+            events.update(LiveUpdateEvent._byID(chunk, return_dict=True))
+
+        self.events = dict((event_id, self.events.get(event_id, now))
+                           for event_id in event_ids)
+        self.quiet_events = set(
+            event_id for event_id in event_ids
+            if event_id not in events or events[event_id].state == "complete")
+        self.failures = dict(
+            (event_id, failures)
+            for event_id, failures in self.failures.iteritems()
+            if event_id in self.events)
+
+    def due(self, now):
+        """Return the ids of the events due a refresh."""
+        return [event_id for event_id, next_run in self.events.iteritems()
+                if next_run <= now]
+
+    def reschedule(self, event_ids, activity, now):
+        """Schedule the next refresh of the events that were just due.
+
+        `activity` has the counts of the ones that succeeded.
+
+        """
+        for event_id in event_ids:
+            if event_id not in self.events:
+                continue
+
+            if event_id not in activity:
+                failures = self.failures.get(event_id, 0) + 1
+                self.failures[event_id] = failures
+                interval = min(ACTIVITY_RETRY_DELAY * 2 ** (failures - 1),
+                               ACTIVITY_IDLE_INTERVAL)
+            elif event_id in self.quiet_events:
+                self.failures.pop(event_id, None)
+                interval = ACTIVITY_IDLE_INTERVAL
+            else:
+                self.failures.pop(event_id, None)
+                interval = _refresh_interval(activity[event_id])
+
+            self.events[event_id] = now + interval
+
+
+def run_daemon():
+    """Keep events' activity up to date until SIGTERM or SIGINT.
+
+    Unlike update_activity, which rescans and refreshes every event each time
+    it's run, this stays running and refreshes busy events frequently and
+    quiet ones rarely.
+
+    """
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        g.log.info("Stopping liveupdate activity daemon (signal %d)", signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    scheduler = ActivityScheduler()
+    pool = ThreadPool(ACTIVITY_WORKERS)
+
+    try:
+        while not stopping.is_set():
+            try:
+                lock = _activity_lock()
+                lock.acquire()
+            except TimeoutExpired:
+                # another daemon or the cron job is running. try again
+                # next tick in case it goes away.
+                stopping.wait(ACTIVITY_DAEMON_TICK)
+                continue
+
+            tick_start = time.time()
+            timer = instrumentation.get_timer("activity_daemon",
+                                              sample_rate=1)
+            totals = collections.Counter()
+
+            try:
+                scheduler.scan(tick_start)
+                timer.intermediate("scan")
+
+                due = scheduler.due(tick_start)
+                for chunk in utils.in_chunks(due, size=ACTIVITY_BATCH_SIZE):
+                    if stopping.is_set():
+                        break
+
+                    activity, abandoned = _update_activity_batch(
+                        pool, chunk, totals, timer)
+                    scheduler.reschedule(chunk, activity, time.time())
+
+                    # don't let stuck requests slowly eat up the pool
+                    if abandoned:
+                        _close_pool(pool, abandoned_workers=True)
+                        pool = ThreadPool(ACTIVITY_WORKERS)
+            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+                g.log.warning("Liveupdate activity tick failed: %s", e)
+                totals["errors"] += 1
+            finally:
+                lock.release()
+
+            _finish_run(timer, totals)
+
+            elapsed = time.time() - tick_start
+            stopping.wait(max(0, ACTIVITY_DAEMON_TICK - elapsed))
+    finally:
+        _close_pool(pool, abandoned_workers=False)
@@ -0,0 +1,248 @@
+import atexit
+import heapq
+import threading
+import time
+
+from pylons import g
+
+from r2.lib import utils, websockets
+
+
+# how long to keep sent messages around for reconnecting clients, and the
+# most messages a client may catch up on before it should just reload.
+MESSAGE_LOG_TTL = 60 * 60
+MAX_CATCHUP_MESSAGES = 100
+
+# counts below this are fuzzed before being shown to anyone
+ACTIVITY_FUZZING_THRESHOLD = 100
+
+# unchanged activity counts are re-sent at least this often (in seconds)
+ACTIVITY_RESEND_INTERVAL = 10 * 60
+ACTIVITY_KEY_PREFIX = "liveupdate_activity_sent_"
+
+
+def _namespace(event_id):
+    return "/live/" + event_id
+
+
+def _sequence_key(event_id):
+    return "liveupdate_message_seq_" + event_id
+
+
+def _message_key(event_id, seq):
+    return "liveupdate_message_%s_%d" % (event_id, seq)
+
+
+def _next_sequence_number(event_id):
+    key = _sequence_key(event_id)
+
+    # seed new counters with the current time in ms so that if the counter
+    # is ever evicted the sequence still only moves forward.
+    g.cache.add(key, int(time.time() * 1000))
+    return g.cache.incr(key)
+
+
+def current_sequence_number(event_id):
+    return g.cache.get(_sequence_key(event_id))
+
+
+def send_event_broadcast(event_id, type, payload):
+    """Send a sequenced message to everyone watching an event.
+
+    The message is logged under its sequence number so that clients who
+    notice a gap (or reconnect) can fetch just the messages they missed
+    with get_messages_since rather than reloading the page.
+
+    """
+    seq = _next_sequence_number(event_id)
+    g.cache.set(_message_key(event_id, seq), (type, payload),
+                time=MESSAGE_LOG_TTL)
+
+    message = {
+        "seq": seq,
+        "type": type,
+        "data": payload,
+    }
+
+    if getattr(g, "liveupdate_broadcast_window", 0) > 0:
+        _get_coalescer().add(event_id, message)
+    else:
+        _send_messages(event_id, [message])
+
+
+def _send_messages(event_id, messages):
+    if len(messages) == 1:
+        message = messages[0]
+        websockets.send_broadcast(
+            namespace=_namespace(event_id),
+            type=message["type"],
+            payload={
+                "seq": message["seq"],
+                "data": message["data"],
+            },
+        )
+    else:
+        websockets.send_broadcast(
+            namespace=_namespace(event_id),
+            type="batch",
+            payload=messages,
+        )
+
+
+class BroadcastCoalescer(object):
+    """Coalesce each event's sequenced messages into batches.
+
+    The first message sent for an event starts a `window` second timer and
+    everything else sent for that event before the timer runs out goes out
+    along with it as a single "batch" message. Each message in the batch
+    keeps its own sequence number so clients apply them just as if they had
+    been sent separately.
+
+    """
+
+    def __init__(self, window):
+        self.window = window
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.deadlines = []
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def add(self, event_id, message):
+        with self.lock:
+            if not self.thread:
+                self._start()
+
+            messages = self.pending.get(event_id)
+            if messages is not None:
+                messages.append(message)
+                return
+
+            self.pending[event_id] = [message]
+            heapq.heappush(self.deadlines,
+                           (time.time() + self.window, event_id))
+
+        self.wakeup.set()
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="liveupdate broadcaster")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush, everything=True)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.deadlines:
+                    timeout = max(0, self.deadlines[0][0] - time.time())
+                else:
+                    timeout = None
+
+            if timeout != 0:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                g.log.exception("Failed to send liveupdate broadcasts")
+
+    def flush(self, everything=False):
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.deadlines and (everything or
+                                      self.deadlines[0][0] <= now):
+                deadline, event_id = heapq.heappop(self.deadlines)
+                due.append((event_id, self.pending.pop(event_id)))
+
+        for event_id, messages in due:
+            _send_messages(event_id, messages)
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def _get_coalescer():
+    global _coalescer
+
+    if not _coalescer:
+        with _coalescer_lock:
+            if not _coalescer:
+                _coalescer = BroadcastCoalescer(
+                    window=g.liveupdate_broadcast_window)
+    return _coalescer
+
+
+def send_activity_broadcasts(activity_by_event):
+    """Send events' visitor counts to their viewers.
+
+    Counts that haven't changed since they were last sent are skipped
+    (though they're still re-sent every ACTIVITY_RESEND_INTERVAL). Returns
+    the number of broadcasts sent.
+
+    """
+    last_sent = g.cache.get_multi(activity_by_event.keys(),
+                                  prefix=ACTIVITY_KEY_PREFIX)
+
+    sent = {}
+    for event_id, count in activity_by_event.iteritems():
+        if last_sent.get(event_id) == count:
+            continue
+
+        is_fuzzed = False
+        displayed_count = count
+        if count < ACTIVITY_FUZZING_THRESHOLD:
+            displayed_count = utils.fuzz_activity(count)
+            is_fuzzed = True
+
+        websockets.send_broadcast(
+            namespace=_namespace(event_id),
+            type="activity",
+            payload={
+                "count": displayed_count,
+                "fuzzed": is_fuzzed,
+            },
+        )
+        sent[event_id] = count
+
+    if sent:
+        g.cache.set_multi(sent, prefix=ACTIVITY_KEY_PREFIX,
+                          time=ACTIVITY_RESEND_INTERVAL)
+    return len(sent)
+
+
+def get_messages_since(event_id, after):
+    """Return (messages, complete) for messages sent after seq `after`.
+
+    `complete` is False if some of the requested messages are no longer
+    available, in which case the client needs to reload instead.
+
+    """
+    current = current_sequence_number(event_id)
+    if not current or after >= current:
+        return [], True
+
+    if current - after > MAX_CATCHUP_MESSAGES:
+        return [], False
+
+    seqs = range(after + 1, current + 1)
+    keys = [_message_key(event_id, seq) for seq in seqs]
+    logged = g.cache.get_multi(keys)
+
+    messages = []
+    for seq, key in zip(seqs, keys):
+        try:
+            type, payload = logged[key]
+        except KeyError:
+            return messages, False
+
+        messages.append({
+            "seq": seq,
+            "type": type,
+            "payload": payload,
+        })
+    return messages, True
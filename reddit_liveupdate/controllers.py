@@ -1,4 +1,6 @@
+import datetime
 import hashlib
+import json
 import os
 
 from pylons import g, c, request, response
@@ -17,72 +19,115 @@ from r2.lib.validator import (
     VByName,
     VCount,
     VExistingUname,
+    VInt,
     VLength,
     VLimit,
     VMarkdown,
+    VAdmin,
     VModhash,
+    VOneOf,
 )
 from r2.models import QueryBuilder, Account, LinkListing, SimpleBuilder
 from r2.lib.errors import errors
 from r2.lib.utils import url_links_builder
 
-from reddit_liveupdate import pages
+from reddit_liveupdate import (
+    broadcast,
+    export,
+    instrumentation,
+    oembed,
+    pagecache,
+    pages,
+    profiler,
+    snapshots,
+    visitorbuffer,
+)
 from reddit_liveupdate.models import (
     LiveUpdate,
+    LiveUpdateActivityRollupsByEvent,
     LiveUpdateEvent,
+    LiveUpdateModificationsByEvent,
     LiveUpdateStream,
-    ActiveVisitorsByLiveUpdateEvent,
 )
 from reddit_liveupdate.validators import (
     VLiveUpdate,
+    VLiveUpdateEventExporter,
     VLiveUpdateEventReporter,
     VLiveUpdateEventManager,
     VLiveUpdateID,
+    VTimeUUID,
     VTimeZone,
 )
 
 
+# actions that admins can profile with ?profile=1, see profiler.py
+PROFILED_ACTIONS = ("listing", "reporters", "update")
+
+
 def send_websocket_broadcast(type, payload):
-    websockets.send_broadcast(namespace="/live/" + c.liveupdate_event._id,
-                              type=type, payload=payload)
+    broadcast.send_event_broadcast(c.liveupdate_event._id,
+                                   type=type, payload=payload)
 
 
 class LiveUpdateBuilder(QueryBuilder):
+    def fetch_more(self, last_item, num_have):
+        # only listings fetch; POST_update just wraps the update it made
+        items = QueryBuilder.fetch_more(self, last_item, num_have)
+        instrumentation.phase("stream_query")
+        return items
+
     def wrap_items(self, items):
+        # lazily backfill pre-rendered bodies for updates written before
+        # rendering moved to write time (or by an older renderer)
+        stale = [item for item in items if item.needs_render]
+        if stale:
+            try:
+                LiveUpdateStream.backfill_rendered_bodies(
+                    c.liveupdate_event, stale)
+            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+                g.log.warning("Failed to backfill rendered updates: %s", e)
+            instrumentation.phase("backfill")
+
         wrapped = []
         for item in items:
             w = self.wrap(item)
             wrapped.append(w)
+        instrumentation.phase("wrap")
+
         pages.liveupdate_add_props(c.user, wrapped)
         return wrapped
 
     def keep_item(self, item):
-        return not item.deleted
+        # deleted updates are moved out of the stream, but events that
+        # haven't been migrated yet (see tombstones.py) may still have some
+        return not item.is_deleted
 
 
 @add_controller
 class LiveUpdatePixelController(BaseController):
-    def __init__(self, *args, **kwargs):
-        self._pixel_data = None
-        BaseController.__init__(self, *args, **kwargs)
+    # shared by every controller instance in the process
+    _pixel_data = None
 
     @property
     def _pixel_contents(self):
-        if not self._pixel_data:
+        if not LiveUpdatePixelController._pixel_data:
             with open(os.path.join(g.paths["root"],
                                    "public/static/pixel.png")) as f:
-                self._pixel_data = f.read()
-        return self._pixel_data
+                LiveUpdatePixelController._pixel_data = f.read()
+        return LiveUpdatePixelController._pixel_data
 
     def GET_pixel(self, event):
         extension = request.environ.get("extension")
         if extension != "png":
             abort(404)
 
+        instrumentation.start_request("pixel")
+
         event_id = event[:50]  # some very simple poor-man's validation
         user_agent = request.user_agent or ''
         user_id = hashlib.sha1(request.ip + user_agent).hexdigest()
-        ActiveVisitorsByLiveUpdateEvent.touch(event_id, user_id)
+        visitorbuffer.touch(event_id, user_id)
+        instrumentation.finish_request()
 
         response.content_type = "image/png"
         response.headers["Cache-Control"] = "no-cache, max-age=0"
@@ -96,11 +141,15 @@ class LiveUpdateController(RedditController):
     def __before__(self, event):
         RedditController.__before__(self)
 
+        routes_dict = request.environ["pylons.routes_dict"]
+        instrumentation.start_request(routes_dict.get("action"))
+
         if event:
             try:
                 c.liveupdate_event = LiveUpdateEvent._byID(event)
             except tdb_cassandra.NotFound:
                 pass
+        instrumentation.phase("event_load")
 
         if not c.liveupdate_event:
             self.abort404()
@@ -112,6 +161,24 @@ class LiveUpdateController(RedditController):
                                   (c.liveupdate_event.is_reporter(c.user) or
                                    c.user_is_admin)))
 
+        if (c.user_is_loggedin and c.user_is_admin and
+                request.params.get("profile") == "1" and
+                routes_dict.get("action") in PROFILED_ACTIONS):
+            c.liveupdate_profiler = profiler.start()
+
+    def __after__(self):
+        if c.liveupdate_profiler:
+            description = "%s %s by %s at %s" % (
+                request.method, request.path, c.user.name,
+                datetime.datetime.utcnow().isoformat())
+            profile_id = profiler.save(c.liveupdate_event._id,
+                                       c.liveupdate_profiler, description)
+            response.headers["X-LiveUpdate-Profile"] = profile_id
+            c.liveupdate_profiler = None
+
+        instrumentation.finish_request()
+        RedditController.__after__(self)
+
     @validate(
         num=VLimit("limit", default=25, max_limit=100),
         after=VLiveUpdateID("after"),
@@ -120,13 +187,80 @@ class LiveUpdateController(RedditController):
         is_embed=VBoolean("is_embed"),
     )
     def GET_listing(self, num, after, before, count, is_embed):
+        # logged out users all get the same page so we can cache the render
+        # and let clients revalidate what they already have
+        cache_key = None
+        if not c.user_is_loggedin:
+            page_etag = pagecache.make_etag(
+                c.liveupdate_event,
+                num=num,
+                after=after,
+                before=before,
+                count=count,
+                is_embed=is_embed,
+                render_style=c.render_style,
+                lang=c.lang,
+                host=request.host,
+                secure=c.secure,
+                bare=bool(request.GET.get("bare")),
+            )
+
+            # the visitor count is left out of the cached render and filled
+            # in per request, but clients should still get a fresh copy of
+            # the page when it changes
+            etag = pagecache.make_etag(
+                c.liveupdate_event,
+                page=page_etag,
+                active_visitors=c.liveupdate_event.active_visitors,
+            )
+            if self._check_not_modified(etag):
+                return ""
+
+            cache_key = pagecache.make_key(page_etag)
+            rendered = pagecache.get_page(cache_key)
+            instrumentation.phase("page_cache")
+            if rendered is not None:
+                if is_embed:
+                    c.allow_framing = True
+                return pages.fill_visitor_count(rendered, c.liveupdate_event)
+
+        # the front page of a completed event is served from its static
+        # snapshot. only the canonical page is snapshotted (and only the
+        # validated parameters go in the key) so that requests with made up
+        # query strings can't fill the store.
+        snapshot_key = None
+        if (not c.user_is_loggedin and
+                c.liveupdate_event.state == "complete" and
+                not after and not before and not count and
+                request.host == g.domain):
+            snapshot_key = snapshots.make_key(
+                c.liveupdate_event._id,
+                num=num,
+                is_embed=is_embed,
+                bare=bool(request.GET.get("bare")),
+                render_style=c.render_style,
+                lang=c.lang,
+                secure=c.secure,
+            )
+            snapshot = snapshots.get_snapshot(snapshot_key)
+            instrumentation.phase("snapshot_lookup")
+            if snapshot:
+                return self._serve_snapshot(snapshot, is_embed)
+
         reverse = False
         if before:
             reverse = True
             after = before
 
-        query = LiveUpdateStream.query([c.liveupdate_event._id],
-                                       count=num, reverse=reverse)
+        # a render that's going to be cached under the event's marker has to
+        # include everything written before the marker was. modifications
+        # write the stream at QUORUM before the marker, so reading it at
+        # QUORUM sees them even if this request got the marker from a
+        # replica that's ahead of the one a CL.ONE read would hit.
+        read_cl = tdb_cassandra.CL.QUORUM if cache_key else None
+        query = LiveUpdateStream.query_for_event(
+            c.liveupdate_event, count=num, reverse=reverse,
+            read_consistency_level=read_cl)
         if after:
             query.column_start = after
 
@@ -134,11 +268,16 @@ class LiveUpdateController(RedditController):
                                     reverse=reverse, num=num,
                                     count=count)
         listing = pages.LiveUpdateListing(builder)
+        visitor_count = None
+        if cache_key:
+            visitor_count = pages.VISITOR_COUNT_PLACEHOLDER
         content = pages.LiveUpdateEvent(
             event=c.liveupdate_event,
             listing=listing.listing(),
             show_sidebar=not is_embed,
+            visitor_count=visitor_count,
         )
+        instrumentation.phase("sidebar")
 
         # don't generate a url unless this is the main page of an event
         websocket_url = None
@@ -147,7 +286,7 @@ class LiveUpdateController(RedditController):
                 "/live/" + c.liveupdate_event._id, max_age=24 * 60 * 60)
 
         if not is_embed:
-            return pages.LiveUpdatePage(
+            rendered = pages.LiveUpdatePage(
                 content=content,
                 websocket_url=websocket_url,
             ).render()
@@ -157,11 +296,176 @@ class LiveUpdateController(RedditController):
             c.liveupdate_can_edit = False
             c.allow_framing = True
 
-            return pages.LiveUpdateEmbed(
+            rendered = pages.LiveUpdateEmbed(
                 content=content,
                 websocket_url=websocket_url,
             ).render()
+        instrumentation.phase("render")
+
+        if cache_key:
+            pagecache.set_page(cache_key, rendered)
+            rendered = pages.fill_visitor_count(rendered, c.liveupdate_event)
+
+            if snapshot_key:
+                snapshots.save_snapshot(snapshot_key, rendered)
+            instrumentation.phase("cache_write")
+
+        return rendered
+
+    def _check_not_modified(self, etag):
+        """Set validators for the response and see if the client's are current.
+
+        If they are, the response is set up as a 304 and True is returned.
+
+        """
+        last_modified = c.liveupdate_event.last_modified
+
+        response.etag = etag
+        if last_modified:
+            response.last_modified = last_modified
+
+        if request.if_none_match:
+            not_modified = etag in request.if_none_match
+        elif last_modified and request.if_modified_since:
+            # http dates only have a resolution of seconds
+            last_modified = last_modified.replace(microsecond=0)
+            not_modified = last_modified <= request.if_modified_since
+        else:
+            not_modified = False
+
+        if not_modified:
+            response.status_int = 304
+        return not_modified
+
+    def _serve_snapshot(self, snapshot, is_embed):
+        if is_embed:
+            c.allow_framing = True
+
+        response.headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.headers["Content-Encoding"] = "gzip"
+            return snapshot
+        return snapshots.decompress(snapshot)
+
+
+    @validate(
+        after=VInt("after", min=0),
+    )
+    def GET_messages(self, after):
+        if after is not None:
+            messages, complete = broadcast.get_messages_since(
+                c.liveupdate_event._id, after)
+        else:
+            messages, complete = [], False
 
+        response.content_type = "application/json"
+        return json.dumps({
+            "messages": messages,
+            "complete": complete,
+        })
+
+    @validate(
+        since=VTimeUUID("since"),
+        num=VLimit("limit", default=100, max_limit=100),
+    )
+    def GET_updates_since(self, since, num):
+        if not since:
+            abort(400)
+
+        event = c.liveupdate_event
+        updates = LiveUpdateStream.get_updates_since(event, since, num)
+        modifications, modifications_complete = (
+            LiveUpdateModificationsByEvent.get_modifications_since(
+                event, since))
+        instrumentation.phase("stream_query")
+
+        author_ids = set(update.author_id for update in updates)
+        authors = event.get_authors(author_ids)
+        instrumentation.phase("accounts")
+
+        deleted = set(id for id, action in modifications
+                      if action == "delete")
+        stricken = set(id for id, action in modifications
+                       if action == "strike")
+        new_updates = []
+        for update in updates:
+            if update.deleted:
+                deleted.add(update._id)
+                continue
+
+            if update.stricken:
+                stricken.add(update._id)
+
+            new_updates.append({
+                "id": str(update._id),
+                "name": update._fullname,
+                "created_utc": update._timestamp,
+                "author": authors[update.author_id].name,
+                "body": update.body,
+                "body_html": update.wrapped_body_html,
+                "stricken": update.stricken,
+            })
+
+        response.content_type = "application/json"
+        return json.dumps({
+            "updates": new_updates,
+            "more": len(updates) == num,
+            # some deletes or strikes couldn't be listed, so reload instead
+            "modifications_truncated": not modifications_complete,
+            "deleted": ["LiveUpdate_%s" % id for id in sorted(deleted)],
+            "stricken": ["LiveUpdate_%s" % id for id in sorted(stricken)],
+        })
+
+    def GET_oembed(self):
+        etag = pagecache.make_etag(
+            c.liveupdate_event,
+            action="oembed",
+            media_domain=g.media_domain,
+        )
+        if self._check_not_modified(etag):
+            return ""
+
+        cache_key = pagecache.make_key(etag)
+        metadata = pagecache.get_page(cache_key)
+        if metadata is None:
+            metadata = json.dumps(oembed.get_metadata(c.liveupdate_event))
+            pagecache.set_page(cache_key, metadata)
+
+        response.content_type = "application/json"
+        return metadata
+
+    @validate(
+        VLiveUpdateEventExporter(),
+        after=VTimeUUID("after"),
+    )
+    def GET_export(self, after):
+        # starting from the beginning instead would have a resuming client
+        # append duplicates
+        if request.GET.get("after") and not after:
+            abort(400)
+
+        response.content_type = "application/x-ndjson"
+        response.headers["Content-Disposition"] = (
+            'attachment; filename="%s.ndjson"' % c.liveupdate_event._id)
+        return export.iter_ndjson(c.liveupdate_event, after=after)
+
+    @validate(
+        VLiveUpdateEventExporter(),
+        resolution=VOneOf("resolution",
+                          LiveUpdateActivityRollupsByEvent.RESOLUTIONS,
+                          default="minute"),
+        start=VInt("start", min=0),
+        end=VInt("end", min=0),
+    )
+    def GET_activity(self, resolution, start, end):
+        series = LiveUpdateActivityRollupsByEvent.get_series(
+            c.liveupdate_event._id, resolution, start=start, end=end)
+
+        response.content_type = "application/json"
+        return json.dumps({
+            "resolution": resolution,
+            "series": series,
+        })
 
     @base_listing
     def GET_discussions(self, num, after, reverse, count):
@@ -213,6 +517,7 @@ class LiveUpdateController(RedditController):
         c.liveupdate_event.title = title
         c.liveupdate_event.description = description
         c.liveupdate_event.timezone = timezone.zone
+        c.liveupdate_event.mark_modified()
         c.liveupdate_event._commit()
 
         form.set_html(".status", _("saved"))
@@ -225,6 +530,7 @@ class LiveUpdateController(RedditController):
                                          editable=c.liveupdate_can_edit)
         accounts = Account._byID(event.reporter_ids,
                                  data=True, return_dict=False)
+        instrumentation.phase("accounts")
         keep_fn = lambda item: not item.user._deleted
         b = SimpleBuilder(
             accounts,
@@ -235,9 +541,28 @@ class LiveUpdateController(RedditController):
         )
         listing = pages.ReporterListing(event, b,
                           editable=c.liveupdate_can_edit).listing()
-        return pages.LiveUpdatePage(
+        instrumentation.phase("build")
+        content = pages.LiveUpdatePage(
             content=listing,
         ).render()
+        instrumentation.phase("render")
+        return content
+
+    @validate(
+        VAdmin(),
+        profile_id=VLength("id", max_length=32),
+    )
+    def GET_profile(self, profile_id):
+        response.content_type = "text/plain"
+
+        if not profile_id:
+            recent = profiler.get_recent_profiles(c.liveupdate_event._id)
+            return "".join("%s %s\n" % profile for profile in recent)
+
+        profile = profiler.get_profile(profile_id)
+        if profile is None:
+            self.abort404()
+        return profile
 
     @validatedForm(
         VLiveUpdateEventReporter(),
@@ -282,13 +607,19 @@ class LiveUpdateController(RedditController):
             "author_id": c.user._id,
             "body": text,
         })
-        LiveUpdateStream.add_update(c.liveupdate_event, update)
+        LiveUpdateStream.post_update(c.liveupdate_event, update)
+        instrumentation.phase("stream_write")
+        c.liveupdate_event.mark_modified(new_update=update)
+        c.liveupdate_event._commit()
+        instrumentation.phase("event_write")
 
         # tell the world about our new update
         builder = LiveUpdateBuilder(None)
         wrapped = builder.wrap_items([update])
         rendered = [w.render() for w in wrapped]
+        instrumentation.phase("render")
         send_websocket_broadcast(type="update", payload=rendered)
+        instrumentation.phase("websocket_send")
 
         # reset the submission form
         t = form.find("textarea")
@@ -303,10 +634,16 @@ class LiveUpdateController(RedditController):
         if form.has_errors("id", errors.NO_THING_ID):
             return
 
-        update.deleted = True
-        LiveUpdateStream.add_update(c.liveupdate_event, update)
+        LiveUpdateStream.delete_update(c.liveupdate_event, update)
+        LiveUpdateModificationsByEvent.record(
+            c.liveupdate_event, update, "delete")
+        instrumentation.phase("stream_write")
+        c.liveupdate_event.mark_modified()
+        c.liveupdate_event._commit()
+        instrumentation.phase("event_write")
 
         send_websocket_broadcast(type="delete", payload=update._fullname)
+        instrumentation.phase("websocket_send")
 
     @validatedForm(
         VLiveUpdateEventReporter(),
@@ -319,5 +656,12 @@ class LiveUpdateController(RedditController):
 
         update.stricken = True
         LiveUpdateStream.add_update(c.liveupdate_event, update)
+        LiveUpdateModificationsByEvent.record(
+            c.liveupdate_event, update, "strike")
+        instrumentation.phase("stream_write")
+        c.liveupdate_event.mark_modified()
+        c.liveupdate_event._commit()
+        instrumentation.phase("event_write")
 
         send_websocket_broadcast(type="strike", payload=update._fullname)
+        instrumentation.phase("websocket_send")
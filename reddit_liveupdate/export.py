@@ -0,0 +1,63 @@
+"""Export whole events as newline-delimited JSON.
+
+Each line is one update, oldest first. Exports can be resumed by passing the
+id or name of the last update received as `after`.
+
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import export; export.export_event("<event id>", "/tmp/event.ndjson")'
+
+"""
+
+import json
+import sys
+
+from r2.lib.utils import to36
+
+from reddit_liveupdate.models import (
+    LiveUpdate,
+    LiveUpdateEvent,
+    LiveUpdateStream,
+)
+
+
+def _update_to_dict(update):
+    # only stored fields are used here: this runs while streaming a response
+    # so it can't rely on anything bound to the request (like rendering).
+    return {
+        "id": str(update._id),
+        "name": update._fullname,
+        "created_utc": update._timestamp,
+        "author": "t2_" + to36(update.author_id),
+        "body": update.body,
+        "body_html": update._data.get("body_html"),
+        "stricken": update.stricken,
+        "deleted": update.deleted,
+    }
+
+
+def iter_ndjson(event, after=None):
+    updates = LiveUpdateStream.iter_updates(event, after=after,
+                                            include_deleted=True)
+    for update in updates:
+        yield json.dumps(_update_to_dict(update)) + "\n"
+
+
+def export_event(event_id, path=None, after=None):
+    event = LiveUpdateEvent._byID(event_id)
+
+    if after:
+        after_id = LiveUpdate.parse_id(after)
+        if not after_id:
+            raise ValueError("not an update id: %r" % after)
+        after = after_id
+
+    if path:
+        output = open(path, "a" if after else "w")
+    else:
+        output = sys.stdout
+
+    try:
+        for line in iter_ndjson(event, after=after):
+            output.write(line)
+    finally:
+        if path:
+            output.close()
@@ -0,0 +1,128 @@
+"""A HyperLogLog cardinality estimator.
+
+With the default precision of 12 the sketch has 4096 one-byte registers and
+estimates cardinality with a standard error of about 1.04 / sqrt(4096), or
+1.6%. That means ~95% of estimates are within 3.3% of the true count.
+Sketches merge losslessly (register-wise max), so sketches built
+independently on different app servers or in different time buckets can be
+combined before estimating.
+
+Serialized sketches use a sparse encoding while few registers are set, which
+keeps sketches for small events (or a single server's share of a big one)
+down to a few hundred bytes.
+
+"""
+
+import hashlib
+import math
+import struct
+
+
+DEFAULT_PRECISION = 12
+
+_HASH_BITS = 64
+_DENSE = "D"
+_SPARSE = "S"
+_SPARSE_ENTRY = struct.Struct("!HB")
+
+
+class HyperLogLog(object):
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        if registers is None:
+            registers = bytearray(self.num_registers)
+        self.registers = registers
+
+    def add(self, value):
+        """Add a value to the sketch.
+
+        Returns True if the sketch changed as a result. Once a sketch has seen
+        a lot of values most additions don't change it, so callers can use this
+        to skip persisting sketches that haven't changed.
+
+        """
+        hashed = int(hashlib.sha1(value).hexdigest()[:_HASH_BITS // 4], 16)
+        remaining_bits = _HASH_BITS - self.precision
+        index = hashed >> remaining_bits
+        rest = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can't merge sketches of differing precision")
+
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge_bytes(self, data):
+        """Merge a serialized sketch into this one.
+
+        This is merge(HyperLogLog.from_bytes(data)), except that a sparse
+        sketch is merged an entry at a time instead of first being expanded
+        to a full set of registers.
+
+        """
+        encoding, precision = struct.unpack_from("!cB", data)
+        if precision != self.precision:
+            raise ValueError("can't merge sketches of differing precision")
+
+        if encoding == _DENSE:
+            self.merge(HyperLogLog(precision, bytearray(data[2:])))
+        elif encoding == _SPARSE:
+            registers = self.registers
+            for offset in xrange(2, len(data), _SPARSE_ENTRY.size):
+                index, rank = _SPARSE_ENTRY.unpack_from(data, offset)
+                if rank > registers[index]:
+                    registers[index] = rank
+        else:
+            raise ValueError("unknown sketch encoding %r" % encoding)
+
+    def cardinality(self):
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank
+                                       for rank in self.registers)
+
+        # small range correction: fall back to linear counting
+        if estimate <= 2.5 * m:
+            empty_registers = self.registers.count(b"\x00")
+            if empty_registers:
+                estimate = m * math.log(float(m) / empty_registers)
+
+        return int(round(estimate))
+
+    def to_bytes(self):
+        header = struct.pack("!cB", _DENSE, self.precision)
+        nonzero = [(index, rank)
+                   for index, rank in enumerate(self.registers) if rank]
+
+        if len(nonzero) * _SPARSE_ENTRY.size >= self.num_registers:
+            return header + bytes(self.registers)
+
+        header = struct.pack("!cB", _SPARSE, self.precision)
+        return header + b"".join(_SPARSE_ENTRY.pack(index, rank)
+                                 for index, rank in nonzero)
+
+    @classmethod
+    def from_bytes(cls, data):
+        encoding, precision = struct.unpack_from("!cB", data)
+        body = data[2:]
+
+        if encoding == _DENSE:
+            return cls(precision, bytearray(body))
+        elif encoding == _SPARSE:
+            sketch = cls(precision)
+            for offset in xrange(0, len(body), _SPARSE_ENTRY.size):
+                index, rank = _SPARSE_ENTRY.unpack_from(body, offset)
+                sketch.registers[index] = rank
+            return sketch
+        else:
+            raise ValueError("unknown sketch encoding %r" % encoding)
@@ -0,0 +1,65 @@
+"""Timers and counters for the plugin's requests and jobs.
+
+Each request to an instrumented action gets a timer named
+"liveupdate.<endpoint>" which records the time spent in each phase of the
+request (event load, stream query, render, ...) as "liveupdate.<endpoint>.
+<phase>" and the whole thing as "liveupdate.<endpoint>.total". Only a
+`liveupdate_stats_sample_rate` fraction of requests are timed; the rest get a
+timer that does nothing. Phases are also marked on the request's profile if
+an admin asked for one (see profiler.py).
+
+"""
+
+import random
+
+from pylons import g, c
+
+
+class _NullTimer(object):
+    def start(self):
+        pass
+
+    def intermediate(self, name):
+        pass
+
+    def stop(self, name="total"):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def get_timer(endpoint, sample_rate=None):
+    """Return a started timer for endpoint (or a null one if not sampled)."""
+    if sample_rate is None:
+        sample_rate = getattr(g, "liveupdate_stats_sample_rate", 0)
+
+    if random.random() >= sample_rate:
+        return NULL_TIMER
+
+    timer = g.stats.get_timer("liveupdate." + endpoint)
+    timer.start()
+    return timer
+
+
+def start_request(endpoint):
+    c.liveupdate_timer = get_timer(endpoint)
+
+
+def phase(name):
+    """Record the time since the last phase of this request as `name`."""
+    timer = c.liveupdate_timer or NULL_TIMER
+    timer.intermediate(name)
+
+    if c.liveupdate_profiler:
+        c.liveupdate_profiler.mark_phase(name)
+
+
+def finish_request():
+    timer = c.liveupdate_timer or NULL_TIMER
+    timer.stop()
+    c.liveupdate_timer = None
+
+
+def count(name, delta=1):
+    g.stats.simple_event("liveupdate." + name, delta=delta)
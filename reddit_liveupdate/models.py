@@ -1,19 +1,52 @@
 import base64
+import collections
 import datetime
+import heapq
 import json
+import os
+import socket
+import threading
+import time
 import uuid
 
 import pytz
 
+from pylons import g
+from pycassa import NotFoundException
 from pycassa.util import convert_uuid_to_time
-from pycassa.system_manager import TIME_UUID_TYPE, UTF8_TYPE
+from pycassa.system_manager import (
+    COUNTER_COLUMN_TYPE,
+    LONG_TYPE,
+    TIME_UUID_TYPE,
+    UTF8_TYPE,
+)
 
 from r2.lib.db import tdb_cassandra
-from r2.lib import utils
+from r2.lib import filters, utils
+from r2.models import Account
+
+from reddit_liveupdate.hll import HyperLogLog
+
+
+# bump this when the markdown renderer changes in a way that affects its
+# output. updates rendered with an older version are re-rendered (and written
+# back) the next time they're read.
+BODY_RENDERER_VERSION = 2
+
+
+class RosterEntry(object):
+    """The parts of an Account needed to show it as an author or reporter."""
+
+    def __init__(self, account):
+        self._id = account._id
+        self._fullname = account._fullname
+        self._deleted = account._deleted
+        self.name = account.name
 
 
 class LiveUpdateEvent(tdb_cassandra.Thing):
     _reporter_prefix = "reporter_"
+    _roster_cache_time = 60 * 60
 
     _use_db = True
     _read_consistency_level = tdb_cassandra.CL.ONE
@@ -22,12 +55,22 @@ class LiveUpdateEvent(tdb_cassandra.Thing):
     _int_props = (
         "active_visitors",
     )
+    _bool_props = (
+        "has_update_count",
+    )
     _defaults = {
         "description": "",
         "timezone": "UTC",
         # one of "live", "complete"
         "state": "live",
         "active_visitors": 0,
+        # one of "single", "migrating", "bucketed". see LiveUpdateStream.
+        "stream_layout": "single",
+        # TimeUUID of the most recent change to the event or its stream
+        "last_modified_id": "",
+        # whether LiveUpdateCountsByEvent is accurate for this event. it is
+        # for new events, older ones need migrating. see tombstones.py.
+        "has_update_count": False,
     }
 
     @classmethod
@@ -36,11 +79,69 @@ class LiveUpdateEvent(tdb_cassandra.Thing):
 
     def add_reporter(self, user):
         self[self._reporter_key(user)] = ""
+        self.mark_modified()
         self._commit()
+        g.cache.delete(self._roster_cache_key)
 
     def remove_reporter(self, user):
         del self[self._reporter_key(user)]
+        self.mark_modified()
         self._commit()
+        g.cache.delete(self._roster_cache_key)
+
+    def mark_modified(self, new_update=None):
+        """Note that the event's rendered pages have changed.
+
+        A new update's own id is used as the marker so the marker always
+        matches the newest update unless something else has changed since.
+        The caller is responsible for committing the event.
+
+        """
+        if new_update:
+            self.last_modified_id = str(new_update._id)
+        else:
+            self.last_modified_id = str(uuid.uuid1())
+
+    @property
+    def last_modified(self):
+        if not self.last_modified_id:
+            return None
+        timestamp = convert_uuid_to_time(uuid.UUID(self.last_modified_id))
+        return datetime.datetime.fromtimestamp(timestamp, pytz.UTC)
+
+    @property
+    def _roster_cache_key(self):
+        return "liveupdate_roster_" + self._id
+
+    def get_roster(self):
+        """Return a RosterEntry for each reporter, sorted by name."""
+        roster = g.cache.get(self._roster_cache_key)
+
+        if roster is None:
+            accounts = Account._byID(self.reporter_ids,
+                                     data=True, return_dict=False)
+            roster = sorted((RosterEntry(account) for account in accounts),
+                            key=lambda entry: entry.name)
+            g.cache.set(self._roster_cache_key, roster,
+                        time=self._roster_cache_time)
+
+        return roster
+
+    def get_authors(self, author_ids):
+        """Return a dict of id -> RosterEntry (or Account) for the authors.
+
+        Current reporters come from the cached roster; only authors who've
+        since been removed as reporters need to be looked up.
+
+        """
+        authors = dict((reporter._id, reporter)
+                       for reporter in self.get_roster())
+
+        missing_ids = set(author_ids) - set(authors)
+        if missing_ids:
+            authors.update(Account._byID(missing_ids, data=True))
+
+        return authors
 
     def is_reporter(self, user):
         return self._reporter_key(user) in self._t
@@ -59,7 +160,7 @@ class LiveUpdateEvent(tdb_cassandra.Thing):
     def new(cls, id, title, **properties):
         if not id:
             id = base64.b32encode(uuid.uuid1().bytes).rstrip("=").lower()
-        event = cls(id, title=title, **properties)
+        event = cls(id, title=title, has_update_count=True, **properties)
         event._commit()
         return event
 
@@ -72,6 +173,21 @@ class LiveUpdateEvent(tdb_cassandra.Thing):
 
 
 class LiveUpdateStream(tdb_cassandra.View):
+    """The updates in each event, keyed by TimeUUID.
+
+    An event's updates live in a single row keyed on the event id unless its
+    stream_layout is "bucketed", in which case they're spread across one row
+    per UTC day ("<event id>:<YYYYMMDD>") and the days in use are indexed in
+    LiveUpdateStreamBucketsByEvent. Events being moved from one layout to the
+    other are "migrating": writes go to both layouts while reads still come
+    from the single row. See sharding.py.
+
+    Deleted updates are moved out of the stream into
+    LiveUpdateDeletedUpdatesByEvent so that listings never have to read past
+    them.
+
+    """
+
     _use_db = True
     _connection_pool = "main"
     _compare_with = TIME_UUID_TYPE
@@ -81,14 +197,129 @@ class LiveUpdateStream(tdb_cassandra.View):
         "default_validation_class": UTF8_TYPE,
     }
 
+    @staticmethod
+    def bucket_for_id(id):
+        timestamp = convert_uuid_to_time(id)
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d")
+
+    @staticmethod
+    def bucket_rowkey(event_id, bucket):
+        return "%s:%s" % (event_id, bucket)
+
+    @classmethod
+    def _rowkey_for_read(cls, event, id):
+        if event.stream_layout == "bucketed":
+            return cls.bucket_rowkey(event._id, cls.bucket_for_id(id))
+        return event._id
+
+    @classmethod
+    def _set_update_columns(cls, event, columns, timestamps=None):
+        rows = {}
+        buckets = set()
+
+        if event.stream_layout in ("single", "migrating"):
+            rows[event._id] = dict(columns)
+
+        if event.stream_layout in ("migrating", "bucketed"):
+            for id, value in columns.iteritems():
+                bucket = cls.bucket_for_id(id)
+                rowkey = cls.bucket_rowkey(event._id, bucket)
+                rows.setdefault(rowkey, {})[id] = value
+                buckets.add(bucket)
+
+            # index the bucket first so the update's never unreachable
+            LiveUpdateStreamBucketsByEvent.add_buckets(event._id, buckets)
+
+        if timestamps is None:
+            for rowkey, row_columns in rows.iteritems():
+                cls._set_values(rowkey, row_columns)
+            return
+
+        write_cl = cls._write_consistency_level
+        with cls._cf.batch(write_consistency_level=write_cl) as batch:
+            for rowkey, row_columns in rows.iteritems():
+                for id, value in row_columns.iteritems():
+                    batch.insert(rowkey, {id: value},
+                                 timestamp=timestamps[id])
+
+    @classmethod
+    def remove_updates(cls, event, ids):
+        rows = {}
+
+        if event.stream_layout in ("single", "migrating"):
+            rows[event._id] = list(ids)
+
+        if event.stream_layout in ("migrating", "bucketed"):
+            for id in ids:
+                rowkey = cls.bucket_rowkey(event._id, cls.bucket_for_id(id))
+                rows.setdefault(rowkey, []).append(id)
+
+        write_cl = cls._write_consistency_level
+        for rowkey, row_ids in rows.iteritems():
+            cls._cf.remove(rowkey, columns=row_ids,
+                           write_consistency_level=write_cl)
+
     @classmethod
     def add_update(cls, event, update):
-        columns = cls._obj_to_column(update)
-        cls._set_values(event._id, columns)
+        if update.needs_render:
+            update.render_body()
+        cls._set_update_columns(event, cls._obj_to_column(update))
+
+    @classmethod
+    def post_update(cls, event, update):
+        """Add a new update to the stream and count it."""
+        cls.add_update(event, update)
+        LiveUpdateCountsByEvent.add_visible(event._id, 1)
+
+    @classmethod
+    def delete_update(cls, event, update):
+        """Move an update from the stream to the deleted updates."""
+        update.deleted = True
+
+        # copy before removing so the update's never lost altogether
+        LiveUpdateDeletedUpdatesByEvent.add_updates(event, [update])
+        cls.remove_updates(event, [update._id])
+        LiveUpdateCountsByEvent.add_visible(event._id, -1)
+
+    @classmethod
+    def backfill_rendered_bodies(cls, event, updates):
+        """Store freshly rendered bodies for updates that need them.
+
+        The columns are re-read and written back just after their original
+        write timestamps so that anything written to them since (a strike,
+        or a delete) still wins.
+
+        """
+        ids_by_rowkey = {}
+        for update in updates:
+            if update.needs_render:
+                rowkey = cls._rowkey_for_read(event, update._id)
+                ids_by_rowkey.setdefault(rowkey, []).append(update._id)
+
+        columns = {}
+        timestamps = {}
+        read_cl = cls._read_consistency_level
+        for rowkey, ids in ids_by_rowkey.iteritems():
+            try:
+                current = cls._cf.get(rowkey, columns=ids,
+                                      include_timestamp=True,
+                                      read_consistency_level=read_cl)
+            except NotFoundException:
+                continue
+
+            for id, (value, timestamp) in current.iteritems():
+                update = LiveUpdate.from_json(id, value)
+                if update.needs_render:
+                    update.render_body()
+                    columns[id] = update.to_json()
+                    timestamps[id] = timestamp + 1
+
+        if columns:
+            cls._set_update_columns(event, columns, timestamps)
 
     @classmethod
     def get_update(cls, event, id):
-        thing = cls._byID(event._id, properties=[id])
+        thing = cls._byID(cls._rowkey_for_read(event, id), properties=[id])
 
         try:
             data = thing._t[id]
@@ -97,6 +328,99 @@ class LiveUpdateStream(tdb_cassandra.View):
         else:
             return LiveUpdate.from_json(id, data)
 
+    @classmethod
+    def query_for_event(cls, event, count, reverse=False,
+                        read_consistency_level=None):
+        """Return a query over the event's updates, newest first by default.
+
+        The stream is read at the column family's consistency level unless
+        another is given.
+
+        """
+        if event.stream_layout == "bucketed" or read_consistency_level:
+            return StreamQuery(event, count=count, reverse=reverse,
+                               read_consistency_level=read_consistency_level)
+        return cls.query([event._id], count=count, reverse=reverse)
+
+    @classmethod
+    def get_updates_since(cls, event, since, count):
+        """Return up to `count` updates newer than `since`, oldest first."""
+        if event.stream_layout == "bucketed":
+            query = StreamQuery(event, count=count, reverse=True)
+            query.column_start = since
+            return list(query)
+
+        try:
+            columns = cls._cf.get(event._id, column_start=since,
+                                  column_count=count + 1)
+        except NotFoundException:
+            return []
+
+        return LiveUpdate.from_columns(
+            (id, data) for id, data in columns.iteritems()
+            if id != since)[:count]
+
+    @classmethod
+    def count_updates(cls, event):
+        """Count the columns in the event's stream, without fetching them.
+
+        For events that haven't been migrated (see tombstones.py) this
+        includes deleted updates.
+
+        """
+        if event.stream_layout == "bucketed":
+            buckets = LiveUpdateStreamBucketsByEvent.get_buckets(event._id)
+            rowkeys = [cls.bucket_rowkey(event._id, bucket)
+                       for bucket in buckets]
+        else:
+            rowkeys = [event._id]
+
+        read_cl = cls._read_consistency_level
+        return sum(cls._cf.get_count(rowkey, read_consistency_level=read_cl)
+                   for rowkey in rowkeys)
+
+    @classmethod
+    def iter_updates(cls, event, after=None, chunk_size=1000,
+                     include_deleted=False):
+        """Yield every update in the event, oldest first.
+
+        Updates are fetched `chunk_size` at a time so memory use doesn't grow
+        with the size of the event. If `after` is given, start just after
+        that update. Deleted updates are only included if `include_deleted`
+        is set.
+
+        """
+        if include_deleted:
+            def by_id(updates):
+                for update in updates:
+                    yield (update._id.time, update._id.bytes), update
+
+            merged = heapq.merge(
+                by_id(cls.iter_updates(event, after, chunk_size)),
+                by_id(LiveUpdateDeletedUpdatesByEvent.iter_updates(
+                    event, after, chunk_size)),
+            )
+            for sort_key, update in merged:
+                yield update
+            return
+
+        if event.stream_layout == "bucketed":
+            rowkeys = []
+            buckets = LiveUpdateStreamBucketsByEvent.get_buckets(event._id)
+            after_bucket = cls.bucket_for_id(after) if after else None
+            for bucket in buckets:
+                if not after_bucket or bucket >= after_bucket:
+                    rowkeys.append(cls.bucket_rowkey(event._id, bucket))
+        else:
+            rowkeys = [event._id]
+
+        for rowkey in rowkeys:
+            columns = cls._cf.xget(rowkey, column_start=after or "",
+                                   buffer_size=chunk_size)
+            for id, value in columns:
+                if id != after:
+                    yield LiveUpdate.from_json(id, value)
+
     @classmethod
     def _obj_to_column(cls, entries):
         entries, is_single = utils.tup(entries, ret_is_single=True)
@@ -106,22 +430,243 @@ class LiveUpdateStream(tdb_cassandra.View):
     @classmethod
     def _column_to_obj(cls, columns):
         # columns = [{colname: colvalue}]
-        return [LiveUpdate.from_json(*column.popitem())
-                for column in utils.tup(columns)]
+        return LiveUpdate.from_columns(column.popitem()
+                                       for column in utils.tup(columns))
+
+
+class LiveUpdateStreamBucketsByEvent(tdb_cassandra.View):
+    """The day buckets holding each bucketed event's updates."""
+
+    _use_db = True
+    _connection_pool = "main"
+    _compare_with = tdb_cassandra.ASCII_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+    _extra_schema_creation_args = {
+        "key_validation_class": tdb_cassandra.ASCII_TYPE,
+    }
+
+    @classmethod
+    def add_buckets(cls, event_id, buckets):
+        if buckets:
+            cls._set_values(event_id, dict.fromkeys(buckets, ""))
+
+    @classmethod
+    def get_buckets(cls, event_id):
+        """Return the event's buckets, oldest first."""
+        return [bucket for bucket, value in cls._cf.xget(event_id)]
+
+
+class StreamQuery(object):
+    """A ViewQuery work-alike that reads an event's stream in either layout.
+
+    Like ViewQuery it returns the newest updates first unless reversed, starts
+    just after column_start if set, and stops after _limit updates. Unlike
+    it, it can read across a bucketed event's rows and at a chosen
+    consistency level.
+
+    """
+
+    def __init__(self, event, count, reverse=False,
+                 read_consistency_level=None):
+        self.event_id = event._id
+        self.bucketed = event.stream_layout == "bucketed"
+        self.read_consistency_level = read_consistency_level
+        self.column_start = None
+        self.column_reversed = not reverse
+        self._limit = count
+
+    def _after(self, thing):
+        self.column_start = thing._id if thing else None
+
+    def _reverse(self):
+        self.column_reversed = not self.column_reversed
+
+    def _rows(self):
+        """Yield each rowkey to read, in order, and where to start in it."""
+        if not self.bucketed:
+            yield self.event_id, self.column_start or ""
+            return
+
+        buckets = LiveUpdateStreamBucketsByEvent.get_buckets(self.event_id)
+        if self.column_reversed:
+            buckets.reverse()
+
+        start_bucket = None
+        if self.column_start:
+            start_bucket = LiveUpdateStream.bucket_for_id(self.column_start)
+            if self.column_reversed:
+                buckets = [b for b in buckets if b <= start_bucket]
+            else:
+                buckets = [b for b in buckets if b >= start_bucket]
+
+        for bucket in buckets:
+            column_start = ""
+            if bucket == start_bucket:
+                column_start = self.column_start
+            yield (LiveUpdateStream.bucket_rowkey(self.event_id, bucket),
+                   column_start)
+
+    def __iter__(self):
+        remaining = self._limit
+        for rowkey, column_start in self._rows():
+            try:
+                columns = LiveUpdateStream._cf.get(
+                    rowkey,
+                    column_start=column_start,
+                    column_count=remaining + 1,
+                    column_reversed=self.column_reversed,
+                    read_consistency_level=self.read_consistency_level,
+                )
+            except NotFoundException:
+                continue
+
+            for id, value in columns.iteritems():
+                if id == self.column_start:
+                    continue
+
+                yield LiveUpdate.from_json(id, value)
+
+                remaining -= 1
+                if remaining <= 0:
+                    return
+
+
+class LiveUpdateDeletedUpdatesByEvent(tdb_cassandra.View):
+    """Updates that have been deleted from each event's stream."""
+
+    _use_db = True
+    _connection_pool = "main"
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.ONE
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+    _extra_schema_creation_args = {
+        "default_validation_class": UTF8_TYPE,
+    }
+
+    @classmethod
+    def add_updates(cls, event, updates):
+        cls._set_values(event._id, dict((update._id, update.to_json())
+                                        for update in updates))
+
+    @classmethod
+    def iter_updates(cls, event, after=None, chunk_size=1000):
+        columns = cls._cf.xget(event._id, column_start=after or "",
+                               buffer_size=chunk_size)
+        for id, value in columns:
+            if id != after:
+                yield LiveUpdate.from_json(id, value)
+
+
+class LiveUpdateCountsByEvent(tdb_cassandra.View):
+    """How many visible (not deleted) updates each event has.
+
+    Only accurate for events with has_update_count set.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _compare_with = tdb_cassandra.ASCII_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.ONE
+    _extra_schema_creation_args = {
+        "key_validation_class": tdb_cassandra.ASCII_TYPE,
+        "default_validation_class": COUNTER_COLUMN_TYPE,
+    }
+
+    @classmethod
+    def add_visible(cls, event_id, delta):
+        cls._cf.add(event_id, "visible", delta,
+                    write_consistency_level=cls._write_consistency_level)
+
+    @classmethod
+    def get_visible(cls, event_id):
+        try:
+            columns = cls._cf.get(
+                event_id, columns=["visible"],
+                read_consistency_level=cls._read_consistency_level)
+        except NotFoundException:
+            return 0
+        return columns["visible"]
+
+
+class LiveUpdateModificationsByEvent(tdb_cassandra.View):
+    """A log of deletes and strikes, so clients can find out what changed.
+
+    Entries are kept for _ttl; clients that have been away longer than that
+    have to reload.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _ttl = datetime.timedelta(days=7)
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.ONE
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+    _extra_schema_creation_args = {
+        "default_validation_class": UTF8_TYPE,
+    }
+
+    @classmethod
+    def record(cls, event, update, action):
+        modification = json.dumps({
+            "id": str(update._id),
+            "action": action,
+        })
+        cls._set_values(event._id, {uuid.uuid1(): modification})
+
+    @classmethod
+    def get_modifications_since(cls, event, since, count=1000):
+        """Return ([(update_id, action)], complete) for modifications made
+        after `since`.
+
+        `since` can be any TimeUUID, e.g. the id of the newest update a
+        client knows of. `complete` is False if there were more than `count`
+        modifications or some may already have expired, in which case the
+        client needs to reload instead.
+
+        """
+        expired_before = time.time() - _ttl_seconds(cls._ttl)
+        complete = convert_uuid_to_time(since) >= expired_before
+
+        try:
+            columns = cls._cf.get(event._id, column_start=since,
+                                  column_count=count + 1)
+        except NotFoundException:
+            return [], complete
+
+        if len(columns) > count:
+            complete = False
+
+        modifications = []
+        for modification in columns.values()[:count]:
+            modification = json.loads(modification)
+            modifications.append((uuid.UUID(modification["id"]),
+                                  modification["action"]))
+        return modifications, complete
 
 
 class LiveUpdate(object):
-    __slots__ = ("_id", "_data")
+    # updates are read in bulk on every listing so keep them small: the
+    # stored JSON isn't decoded until a field is actually read, and the
+    # timestamp derived from the TimeUUID is only computed once.
+    __slots__ = ("_id", "_raw", "_decoded", "_cached_timestamp",
+                 "_cached_date")
     defaults = {
         "deleted": False,
         "stricken": False,
     }
 
-    def __init__(self, id=None, data=None):
+    def __init__(self, id=None, data=None, raw=None):
         if not id:
             id = uuid.uuid1()
         self._id = id
-        self._data = data or {}
+        self._raw = raw
+        self._decoded = None if raw is not None else (data or {})
+        self._cached_timestamp = None
+        self._cached_date = None
 
     def __getattr__(self, name):
         try:
@@ -138,17 +683,86 @@ class LiveUpdate(object):
         else:
             self._data[name] = value
 
+    @property
+    def _data(self):
+        if self._decoded is None:
+            self._decoded = json.loads(self._raw)
+            self._raw = None
+        return self._decoded
+
+    @property
+    def is_deleted(self):
+        """Like `deleted` but without decoding updates that never were."""
+        if self._decoded is None and '"deleted"' not in self._raw:
+            return False
+        return self.deleted
+
+    @property
+    def needs_render(self):
+        return self._data.get("body_html_version") != BODY_RENDERER_VERSION
+
+    def render_body(self):
+        # stored without the <div class="md"> wrapper since the listing's
+        # row template provides its own. see wrapped_body_html.
+        self._data["body_html"] = filters.spaceCompress(
+            filters.safemarkdown(self.body, wrap=False))
+        self._data["body_html_version"] = BODY_RENDERER_VERSION
+
+    @property
+    def body_html(self):
+        if self.needs_render:
+            self.render_body()
+        return self._data["body_html"]
+
+    @property
+    def wrapped_body_html(self):
+        """The body as safemarkdown renders it by default, for the API."""
+        return (filters.SC_OFF + filters.MD_START + self.body_html +
+                filters.MD_END + filters.SC_ON)
+
     def to_json(self):
-        return json.dumps(self._data)
+        # if nothing's been read there's nothing that could have changed
+        if self._decoded is None:
+            return self._raw
+        return json.dumps(self._decoded)
 
     @classmethod
     def from_json(cls, id, value):
-        return cls(id, json.loads(value))
+        return cls(id, raw=value)
+
+    @classmethod
+    def parse_id(cls, value):
+        """Return the TimeUUID in an id or fullname, or None if invalid."""
+        prefix = cls.__name__ + "_"
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+
+        try:
+            id = uuid.UUID(value)
+        except (ValueError, TypeError):
+            return None
+
+        if id.version == 1:
+            return id
+        return None
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Build updates from an iterable of (id, json) column pairs."""
+        return [cls(id, raw=value) for id, value in columns]
+
+    @property
+    def _timestamp(self):
+        if self._cached_timestamp is None:
+            self._cached_timestamp = convert_uuid_to_time(self._id)
+        return self._cached_timestamp
 
     @property
     def _date(self):
-        timestamp = convert_uuid_to_time(self._id)
-        return datetime.datetime.fromtimestamp(timestamp, pytz.UTC)
+        if self._cached_date is None:
+            self._cached_date = datetime.datetime.fromtimestamp(
+                self._timestamp, pytz.UTC)
+        return self._cached_date
 
     @property
     def _fullname(self):
@@ -167,20 +781,212 @@ class ActiveVisitorsByLiveUpdateEvent(tdb_cassandra.View):
     _read_consistency_level  = tdb_cassandra.CL.ONE
     _write_consistency_level = tdb_cassandra.CL.ANY
 
+    @classmethod
+    def _counter(cls):
+        if getattr(g, "liveupdate_visitor_counter", "columns") == "hll":
+            return ActiveVisitorSketchesByLiveUpdateEvent
+        return cls
+
     @classmethod
     def touch(cls, event_id, hash):
-        cls._set_values(event_id, {hash: ''})
+        cls.touch_multi(event_id, [hash])
+
+    @classmethod
+    def touch_multi(cls, event_id, hashes):
+        cls._counter()._touch_multi(event_id, hashes)
+        LiveUpdateActiveEventsIndex.mark_active(event_id)
 
     @classmethod
     def get_count(cls, event_id):
+        return cls._counter()._get_count(event_id)
+
+    @classmethod
+    def _touch_multi(cls, event_id, hashes):
+        cls._set_values(event_id, dict.fromkeys(hashes, ''))
+
+    @classmethod
+    def _get_count(cls, event_id):
         return cls._cf.get_count(event_id)
 
 
+class ActiveVisitorSketchesByLiveUpdateEvent(tdb_cassandra.View):
+    """HyperLogLog based storage for ActiveVisitorsByLiveUpdateEvent.
+
+    Rather than a column per visitor, each app process keeps a sketch of the
+    visitors it has seen per event in the current minute and writes it to
+    its own column ("<minute>:<host>:<pid>") when it changes, at most once
+    every _write_interval seconds per event. Columns expire at the end of
+    the activity window so counting is a matter of merging everything left
+    in the row. See hll.py for the error bounds.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _ttl = ActiveVisitorsByLiveUpdateEvent._ttl
+    _value_type = "bytes"  # use pycassa, not tdb_c*, to serialize
+
+    _extra_schema_creation_args = dict(
+        key_validation_class=tdb_cassandra.ASCII_TYPE,
+    )
+
+    _read_consistency_level = tdb_cassandra.CL.ONE
+    _write_consistency_level = tdb_cassandra.CL.ANY
+
+    _hostname = socket.gethostname()
+    _write_interval = 10
+    _sketches_lock = threading.Lock()
+    _sketches_minute = None
+    _sketches = {}
+    _unwritten = set()
+    _last_written = {}
+
+    @classmethod
+    def _touch_multi(cls, event_id, hashes):
+        now = time.time()
+        minute = int(now // 60)
+        writes = []
+
+        with cls._sketches_lock:
+            if minute != cls._sketches_minute:
+                # nothing will touch last minute's sketches again, so this
+                # is the last chance to write out their changes
+                for unwritten_id in cls._unwritten:
+                    writes.append((unwritten_id, cls._sketches_minute,
+                                   cls._sketches[unwritten_id].to_bytes()))
+
+                cls._sketches_minute = minute
+                cls._sketches = {}
+                cls._unwritten = set()
+                cls._last_written = {}
+
+            sketch = cls._sketches.get(event_id)
+            if not sketch:
+                sketch = cls._sketches[event_id] = HyperLogLog()
+
+            for hash in hashes:
+                if sketch.add(hash):
+                    cls._unwritten.add(event_id)
+
+            last_written = cls._last_written.get(event_id, 0)
+            if (event_id in cls._unwritten and
+                    now - last_written >= cls._write_interval):
+                cls._unwritten.discard(event_id)
+                cls._last_written[event_id] = now
+                writes.append((event_id, minute, sketch.to_bytes()))
+
+        # the pid is looked up here rather than at import so that forked
+        # workers each get a column of their own
+        pid = os.getpid()
+        for written_id, written_minute, serialized in writes:
+            column = "%d:%s:%d" % (written_minute, cls._hostname, pid)
+            cls._set_values(written_id, {column: serialized})
+
+    @classmethod
+    def _get_count(cls, event_id):
+        merged = HyperLogLog()
+        for column, serialized in cls._cf.xget(event_id):
+            merged.merge_bytes(serialized)
+        return merged.cardinality()
+
+
+def _ttl_seconds(ttl):
+    if ttl is None:
+        return None
+    return ttl.days * 24 * 60 * 60 + ttl.seconds
+
+
+class LiveUpdateActiveEventsIndex(tdb_cassandra.View):
+    """The events that have had visitors recently.
+
+    Recording visitors marks their event active here, at most once a minute
+    per process. Marks expire a little after the visitors themselves would,
+    and the activity job removes events once their count has dropped to
+    zero, so this stays about as big as the number of live events.
+
+    Marks go in a row per _bucket_size seconds so the expired and removed
+    columns pile up in rows nobody reads any more rather than in one hot
+    row. Since a bucket is as long as a mark lives, the current and
+    previous buckets hold every live mark.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _ttl = ActiveVisitorsByLiveUpdateEvent._ttl + datetime.timedelta(minutes=5)
+    _compare_with = tdb_cassandra.ASCII_TYPE
+    _read_consistency_level = tdb_cassandra.CL.ONE
+    _write_consistency_level = tdb_cassandra.CL.ONE
+    _extra_schema_creation_args = {
+        "key_validation_class": tdb_cassandra.ASCII_TYPE,
+    }
+
+    _bucket_size = _ttl_seconds(_ttl)
+    _mark_interval = 60
+    _marked_lock = threading.Lock()
+    _last_marked = {}
+    _next_prune = 0
+
+    @classmethod
+    def _rowkey(cls, bucket):
+        return "active:%d" % bucket
+
+    @classmethod
+    def _live_rowkeys(cls, now):
+        bucket = int(now) // cls._bucket_size
+        return [cls._rowkey(bucket - 1), cls._rowkey(bucket)]
+
+    @classmethod
+    def mark_active(cls, event_id):
+        now = time.time()
+        with cls._marked_lock:
+            if now - cls._last_marked.get(event_id, 0) < cls._mark_interval:
+                return
+            cls._last_marked[event_id] = now
+
+            # forget events that are past the interval anyway so the pixel
+            # being hit for lots of (possibly bogus) ids can't grow this
+            if now >= cls._next_prune:
+                cls._next_prune = now + cls._mark_interval
+                for marked_id, marked_at in cls._last_marked.items():
+                    if now - marked_at >= cls._mark_interval:
+                        del cls._last_marked[marked_id]
+
+        rowkey = cls._rowkey(int(now) // cls._bucket_size)
+        cls._set_values(rowkey, {event_id: ""})
+
+    @classmethod
+    def get_event_ids(cls):
+        event_ids = []
+        seen = set()
+        for rowkey in cls._live_rowkeys(time.time()):
+            for event_id, value in cls._cf.xget(rowkey):
+                if event_id not in seen:
+                    seen.add(event_id)
+                    event_ids.append(event_id)
+        return event_ids
+
+    @classmethod
+    def remove_events(cls, event_ids):
+        write_cl = cls._write_consistency_level
+        with cls._cf.batch(write_consistency_level=write_cl) as batch:
+            for rowkey in cls._live_rowkeys(time.time()):
+                batch.remove(rowkey, columns=event_ids)
+
+
 class LiveUpdateActivityHistoryByEvent(tdb_cassandra.View):
+    """The raw activity count from each run of the activity job.
+
+    Raw points are only kept for a couple of days; anything longer term
+    should come from LiveUpdateActivityRollupsByEvent.
+
+    """
+
     _use_db = True
     _connection_pool = "main"
     _compare_with = "TimeUUIDType"
     _value_type = "bytes"  # use pycassa, not tdb_c*, to serialize
+    _ttl = datetime.timedelta(days=2)
     _read_consistency_level = tdb_cassandra.CL.QUORUM
     _write_consistency_level = tdb_cassandra.CL.QUORUM
     _extra_schema_creation_args = {
@@ -189,4 +995,132 @@ class LiveUpdateActivityHistoryByEvent(tdb_cassandra.View):
 
     @classmethod
     def record_activity(cls, event_id, activity_count):
-        cls._set_values(event_id, {uuid.uuid1(): activity_count})
+        cls.record_activity_batch({event_id: activity_count})
+
+    @classmethod
+    def record_activity_batch(cls, activity_by_event):
+        write_cl = cls._write_consistency_level
+        ttl = _ttl_seconds(cls._ttl)
+        with cls._cf.batch(write_consistency_level=write_cl) as batch:
+            for event_id, activity_count in activity_by_event.iteritems():
+                batch.insert(event_id, {uuid.uuid1(): activity_count},
+                             ttl=ttl)
+
+        LiveUpdateActivityRollupsByEvent.record_activity_batch(
+            activity_by_event)
+
+
+class LiveUpdateActivityRollupsByEvent(tdb_cassandra.View):
+    """Per-minute, per-hour and per-day aggregates of event activity.
+
+    Each event has a row per resolution, keyed "<event id>:<resolution>",
+    with a column per time bucket named by the bucket's start in seconds
+    since the epoch. The value is a JSON object of the min, max, sum, count
+    and last of the activity counts recorded during the bucket; buckets are
+    updated in place as counts come in.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _compare_with = LONG_TYPE
+    _value_type = "bytes"  # use pycassa, not tdb_c*, to serialize
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+    _extra_schema_creation_args = {
+        "key_validation_class": tdb_cassandra.ASCII_TYPE,
+        "default_validation_class": UTF8_TYPE,
+    }
+
+    # resolution -> (bucket size in seconds, how long to keep its buckets)
+    RESOLUTIONS = collections.OrderedDict([
+        ("minute", (60, datetime.timedelta(days=7))),
+        ("hour", (60 * 60, datetime.timedelta(days=90))),
+        ("day", (24 * 60 * 60, None)),
+    ])
+
+    # the most buckets returned by one query
+    MAX_POINTS = 1440
+
+    @staticmethod
+    def _rowkey(event_id, resolution):
+        return "%s:%s" % (event_id, resolution)
+
+    @staticmethod
+    def _add_to_bucket(serialized, activity_count):
+        if not serialized:
+            return {
+                "min": activity_count,
+                "max": activity_count,
+                "sum": activity_count,
+                "count": 1,
+                "last": activity_count,
+            }
+
+        bucket = json.loads(serialized)
+        bucket["min"] = min(bucket["min"], activity_count)
+        bucket["max"] = max(bucket["max"], activity_count)
+        bucket["sum"] += activity_count
+        bucket["count"] += 1
+        bucket["last"] = activity_count
+        return bucket
+
+    @classmethod
+    def record_activity_batch(cls, activity_by_event, now=None):
+        if not activity_by_event:
+            return
+
+        now = now or time.time()
+        read_cl = cls._read_consistency_level
+        write_cl = cls._write_consistency_level
+
+        with cls._cf.batch(write_consistency_level=write_cl) as batch:
+            for resolution, (size, keep) in cls.RESOLUTIONS.iteritems():
+                bucket = int(now // size * size)
+                rowkeys = dict((cls._rowkey(event_id, resolution), event_id)
+                               for event_id in activity_by_event)
+                existing = cls._cf.multiget(rowkeys.keys(), columns=[bucket],
+                                            read_consistency_level=read_cl)
+
+                for rowkey, event_id in rowkeys.iteritems():
+                    serialized = existing.get(rowkey, {}).get(bucket)
+                    aggregate = cls._add_to_bucket(
+                        serialized, activity_by_event[event_id])
+                    batch.insert(rowkey, {bucket: json.dumps(aggregate)},
+                                 ttl=_ttl_seconds(keep))
+
+    @classmethod
+    def get_series(cls, event_id, resolution, start=None, end=None):
+        """Return the buckets between start and end (epoch seconds).
+
+        Buckets are returned oldest first as dicts of their start time and
+        min, max, avg and last activity. If there are more than MAX_POINTS
+        buckets in the range, the oldest are left out.
+
+        """
+
+        # read newest-first so that an open-ended range gets the latest
+        # buckets rather than the first ones ever recorded
+        try:
+            columns = cls._cf.get(
+                cls._rowkey(event_id, resolution),
+                column_start=end if end is not None else "",
+                column_finish=start if start is not None else "",
+                column_count=cls.MAX_POINTS,
+                column_reversed=True,
+                read_consistency_level=cls._read_consistency_level,
+            )
+        except NotFoundException:
+            return []
+
+        series = []
+        for bucket_start, serialized in reversed(columns.items()):
+            bucket = json.loads(serialized)
+            series.append({
+                "time": bucket_start,
+                "min": bucket["min"],
+                "max": bucket["max"],
+                "avg": float(bucket["sum"]) / bucket["count"],
+                "last": bucket["last"],
+            })
+        return series
@@ -0,0 +1,68 @@
+"""oEmbed-style metadata about events, for link previews.
+
+This is everything a preview needs (including the HTML to embed the event)
+without having to build the embed page itself.
+
+"""
+
+from reddit_liveupdate.models import LiveUpdateCountsByEvent, LiveUpdateStream
+from reddit_liveupdate.scraper import (
+    EMBED_HEIGHT,
+    EMBED_WIDTH,
+    make_embed_html,
+)
+
+
+SNIPPET_LENGTH = 200
+
+# how many of the newest updates to look through for one that isn't deleted
+LATEST_SLICE_SIZE = 25
+
+
+def _snippet(text):
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+    return text[:SNIPPET_LENGTH - 1].rstrip() + u"\u2026"
+
+
+def _latest_update(event):
+    # events that haven't been migrated (see tombstones.py) may still have
+    # deleted updates at the head of their streams
+    query = LiveUpdateStream.query_for_event(event, count=LATEST_SLICE_SIZE)
+    for update in query:
+        if not update.is_deleted:
+            return update
+    return None
+
+
+def get_metadata(event):
+    if event.has_update_count:
+        num_updates = LiveUpdateCountsByEvent.get_visible(event._id)
+    else:
+        # until the event's migrated this includes its deleted updates
+        num_updates = LiveUpdateStream.count_updates(event)
+    latest = _latest_update(event)
+
+    if latest:
+        latest_update = {
+            "id": str(latest._id),
+            "name": latest._fullname,
+            "created_utc": latest._timestamp,
+            "snippet": _snippet(latest.body),
+            "stricken": latest.stricken,
+        }
+    else:
+        latest_update = None
+
+    return {
+        "type": "rich",
+        "version": "1.0",
+        "provider_name": "reddit",
+        "title": event.title,
+        "state": event.state,
+        "num_updates": num_updates,
+        "latest_update": latest_update,
+        "width": EMBED_WIDTH,
+        "height": EMBED_HEIGHT,
+        "html": make_embed_html(event._id),
+    }
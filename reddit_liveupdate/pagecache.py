@@ -0,0 +1,31 @@
+import hashlib
+
+from pylons import g
+
+
+RENDER_CACHE_TIME = 60 * 60
+
+
+def make_etag(event, **params):
+    """Return an entity tag for a rendered page of the given event.
+
+    The tag embeds the event's last-modified marker (see
+    LiveUpdateEvent.mark_modified), so any change to the event produces new
+    tags for every one of its pages without having to enumerate them.
+
+    """
+    params_str = "&".join("%s=%s" % (k, params[k]) for k in sorted(params))
+    key_str = "%s|%s|%s" % (event._id, event.last_modified_id, params_str)
+    return hashlib.md5(key_str.encode("utf-8")).hexdigest()
+
+
+def make_key(etag):
+    return "liveupdate_render_" + etag
+
+
+def get_page(key):
+    return g.cache.get(key)
+
+
+def set_page(key, content):
+    g.cache.set(key, content, time=RENDER_CACHE_TIME)
@@ -1,5 +1,6 @@
 import collections
 import datetime
+import time
 import urllib
 
 import pytz
@@ -7,13 +8,12 @@ import pytz
 from pylons import c, g
 from pylons.i18n import _, ungettext
 
-from r2.lib import filters
 from r2.lib.pages import Reddit, UserTableItem
 from r2.lib.menus import NavMenu, NavButton
 from r2.lib.template_helpers import add_sr
 from r2.lib.memoize import memoize
-from r2.lib.wrapped import Templated, Wrapped
-from r2.models import Account, Subreddit, Link, NotFound, Listing, UserListing
+from r2.lib.wrapped import Templated
+from r2.models import Subreddit, Link, NotFound, Listing, UserListing
 from r2.lib.strings import strings
 from r2.lib.utils import tup, fuzz_activity
 from r2.lib.jsontemplates import (
@@ -22,8 +22,27 @@ from r2.lib.jsontemplates import (
     ThingJsonTemplate,
 )
 
-from reddit_liveupdate.activity import ACTIVITY_FUZZING_THRESHOLD
-from reddit_liveupdate.utils import pretty_time, pairwise
+from reddit_liveupdate import broadcast, instrumentation
+from reddit_liveupdate.broadcast import ACTIVITY_FUZZING_THRESHOLD
+from reddit_liveupdate.utils import long_time, pretty_time, pairwise
+
+
+# stands in for the visitor count in renders that get cached, since the count
+# changes much more often than the rest of the page. see fill_visitor_count.
+VISITOR_COUNT_PLACEHOLDER = "__liveupdate_visitor_count__"
+
+
+def format_visitor_count(event):
+    count = event.active_visitors
+
+    if count < ACTIVITY_FUZZING_THRESHOLD and not c.user_is_admin:
+        return "~%d" % fuzz_activity(count)
+    return str(count)
+
+
+def fill_visitor_count(rendered, event):
+    return rendered.replace(VISITOR_COUNT_PLACEHOLDER,
+                            format_visitor_count(event))
 
 
 class LiveUpdateTitle(Templated):
@@ -43,6 +62,8 @@ class LiveUpdatePage(Reddit):
 
         if websocket_url:
             extra_js_config["liveupdate_websocket"] = websocket_url
+            extra_js_config["liveupdate_last_seq"] = (
+                broadcast.current_sequence_number(c.liveupdate_event._id))
 
         title = c.liveupdate_event.title
         if c.liveupdate_event.state == "live":
@@ -91,29 +112,19 @@ class LiveUpdateEmbed(LiveUpdatePage):
 
 
 class LiveUpdateEvent(Templated):
-    def __init__(self, event, listing, show_sidebar):
+    def __init__(self, event, listing, show_sidebar, visitor_count=None):
         self.event = event
         self.listing = listing
-        self.visitor_count = self._get_active_visitors()
+        self.visitor_count = visitor_count or format_visitor_count(event)
         if show_sidebar:
             self.discussions = LiveUpdateOtherDiscussions()
         self.show_sidebar = show_sidebar
 
-        reporter_accounts = Account._byID(event.reporter_ids,
-                                          data=True, return_dict=False)
-        self.reporters = sorted((LiveUpdateAccount(e)
-                                 for e in reporter_accounts),
-                                key=lambda e: e.name)
+        self.reporters = [LiveUpdateAccount(reporter)
+                          for reporter in event.get_roster()]
 
         Templated.__init__(self)
 
-    def _get_active_visitors(self):
-        count = self.event.active_visitors
-
-        if count < ACTIVITY_FUZZING_THRESHOLD and not c.user_is_admin:
-            return "~%d" % fuzz_activity(count)
-        return count
-
 
 class LiveUpdateEventConfiguration(Templated):
     def __init__(self):
@@ -202,7 +213,7 @@ class LiveUpdateJsonTemplate(ThingJsonTemplate):
         if attr == "_id":
             return str(thing._id)
         elif attr == "body_html":
-            return filters.spaceCompress(filters.safemarkdown(thing.body))
+            return thing.wrapped_body_html
         return ThingJsonTemplate.thing_attr(self, thing, attr)
 
     def kind(self, wrapped):
@@ -218,13 +229,27 @@ class LiveUpdateAccount(Templated):
         )
 
 
+DiscussionLink = collections.namedtuple(
+    "DiscussionLink", "title permalink subreddit_name num_comments")
+
+
 class LiveUpdateOtherDiscussions(Templated):
     max_links = 5
+    # the list is rebuilt once it's older than cache_time, but a stale copy is
+    # served for up to stale_cache_time while someone's rebuilding it
+    cache_time = 60
+    stale_cache_time = 10 * 60
+    rebuild_lock_time = 30
 
     def __init__(self):
         links = self.get_links(c.liveupdate_event._id)
         self.more_links = len(links) > self.max_links
-        self.links = links[:self.max_links]
+        self.links = []
+        for link in links[:self.max_links]:
+            comment_label = ungettext("comment", "comments", link.num_comments)
+            comments_label = strings.number_label % dict(
+                num=link.num_comments, thing=comment_label)
+            self.links.append((link, comments_label))
         self.submit_url = "/submit?" + urllib.urlencode({
             "url": add_sr("/live/" + c.liveupdate_event._id,
                           sr_path=False, force_hostname=True),
@@ -246,7 +271,7 @@ class LiveUpdateOtherDiscussions(Templated):
         return [link._id for link in links]
 
     @classmethod
-    def get_links(cls, event_id):
+    def _build_links(cls, event_id):
         link_ids = cls._get_related_link_ids(event_id)
         links = Link._byID(link_ids, data=True, return_dict=False)
         links.sort(key=lambda L: L.num_comments, reverse=True)
@@ -254,24 +279,50 @@ class LiveUpdateOtherDiscussions(Templated):
         sr_ids = set(L.sr_id for L in links)
         subreddits = Subreddit._byID(sr_ids, data=True)
 
-        wrapped = []
+        discussions = []
         for link in links:
-            w = Wrapped(link)
-
-            w.subreddit = subreddits[link.sr_id]
+            subreddit = subreddits[link.sr_id]
 
             # ideally we'd check if the user can see the subreddit, but by
             # doing this we keep everything user unspecific which makes caching
             # easier.
-            if w.subreddit.type == "private":
+            if subreddit.type == "private":
                 continue
 
-            comment_label = ungettext("comment", "comments", link.num_comments)
-            w.comments_label = strings.number_label % dict(
-                num=link.num_comments, thing=comment_label)
+            discussions.append(DiscussionLink(
+                title=link.title,
+                permalink=link.make_permalink(subreddit),
+                subreddit_name=subreddit.name,
+                num_comments=link.num_comments,
+            ))
+
+            # one extra so we know whether to show the "see more" link
+            if len(discussions) > cls.max_links:
+                break
+        return discussions
+
+    @classmethod
+    def get_links(cls, event_id):
+        key = "liveupdate_discussions_" + event_id
+        cached = g.cache.get(key)
+        if cached:
+            built_at, links = cached
+            if time.time() - built_at < cls.cache_time:
+                return links
+
+            # it's stale. only one request gets to rebuild it, everyone else
+            # makes do with the stale copy in the meantime.
+            lock_key = key + "_rebuild"
+            if not g.cache.add(lock_key, True, time=cls.rebuild_lock_time):
+                return links
+        else:
+            lock_key = None
 
-            wrapped.append(w)
-        return wrapped
+        links = cls._build_links(event_id)
+        g.cache.set(key, (time.time(), links), time=cls.stale_cache_time)
+        if lock_key:
+            g.cache.delete(lock_key)
+        return links
 
 
 class LiveUpdateSeparator(Templated):
@@ -300,10 +351,13 @@ class LiveUpdateListing(Listing):
 
 
 def liveupdate_add_props(user, wrapped):
-    account_ids = set(w.author_id for w in wrapped)
-    accounts = Account._byID(account_ids, data=True)
+    author_ids = set(w.author_id for w in wrapped)
+    accounts = c.liveupdate_event.get_authors(author_ids)
+    instrumentation.phase("accounts")
 
     for item in wrapped:
         item.author = LiveUpdateAccount(accounts[item.author_id])
 
         item.date_str = pretty_time(item._date)
+        item.date_title = long_time(item._date)
+    instrumentation.phase("format_dates")
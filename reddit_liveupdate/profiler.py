@@ -0,0 +1,143 @@
+"""On-demand sampling profiler for single requests.
+
+Admins can profile their own request to an event's listing, reporters page or
+update form by adding `profile=1` to it. While the request runs, a background
+thread samples its stack every few milliseconds. Each sample is attributed to
+the instrumentation phase (see instrumentation.py) it fell in, so the result
+breaks down both by phase and by function.
+
+Profiles are kept in memcache for a day in the "collapsed stack" format that
+flamegraph.pl and speedscope read. The response carries the profile's id in
+an X-LiveUpdate-Profile header, and the profile can be fetched from
+/live/<event>/profile?id=<id> (or that URL without an id lists the event's
+recent profiles).
+
+"""
+
+import bisect
+import collections
+import os
+import re
+import sys
+import thread
+import threading
+import time
+import uuid
+
+from pylons import g
+
+
+SAMPLE_INTERVAL = 0.005
+MAX_STACK_DEPTH = 100
+MAX_SAMPLES = 12000  # a minute's worth, in case nothing ever stops it
+PROFILE_CACHE_TIME = 24 * 60 * 60
+MAX_RECENT_PROFILES = 20
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return "%s:%s" % (filename, code.co_name)
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id = thread.get_ident()
+        self.samples = []
+        self.phases = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name="liveupdate profiler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while (not self.stopped.wait(self.interval) and
+               len(self.samples) < MAX_SAMPLES):
+            frame = sys._current_frames().get(self.thread_id)
+
+            stack = []
+            while frame and len(stack) < MAX_STACK_DEPTH:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+
+            self.samples.append((time.time(), tuple(stack)))
+
+    def mark_phase(self, name):
+        """Note that the phase called `name` just ended."""
+        self.phases.append((time.time(), name))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed_stacks(self):
+        """Return the profile in collapsed stack format.
+
+        Each line is a semicolon-separated stack, root first and prefixed
+        with the phase it was sampled in, followed by how many samples had
+        that stack.
+
+        """
+        phase_ends = [end for end, name in self.phases]
+        counts = collections.Counter()
+        for sampled_at, stack in self.samples:
+            index = bisect.bisect_left(phase_ends, sampled_at)
+            if index < len(self.phases):
+                phase = self.phases[index][1]
+            else:
+                phase = "finish"
+            counts[("phase:" + phase,) + stack] += 1
+
+        return "".join("%s %d\n" % (";".join(stack), count)
+                       for stack, count in sorted(counts.iteritems()))
+
+
+def start():
+    profiler = SamplingProfiler()
+    profiler.start()
+    return profiler
+
+
+def _profile_key(profile_id):
+    return "liveupdate_profile_" + profile_id
+
+
+def _recent_key(event_id):
+    return "liveupdate_recent_profiles_" + event_id
+
+
+def save(event_id, profiler, description):
+    """Stop the profiler and store what it collected. Returns the id."""
+    profiler.stop()
+
+    profile_id = uuid.uuid4().hex
+    header = "# %s (%d samples every %dms)\n" % (
+        description, len(profiler.samples), profiler.interval * 1000)
+    g.cache.set(_profile_key(profile_id),
+                header + profiler.collapsed_stacks(),
+                time=PROFILE_CACHE_TIME)
+
+    recent = g.cache.get(_recent_key(event_id)) or []
+    recent.insert(0, (profile_id, description))
+    g.cache.set(_recent_key(event_id), recent[:MAX_RECENT_PROFILES],
+                time=PROFILE_CACHE_TIME)
+
+    return profile_id
+
+
+def get_profile(profile_id):
+    if not profile_id or not _PROFILE_ID.match(profile_id):
+        return None
+    return g.cache.get(_profile_key(profile_id))
+
+
+def get_recent_profiles(event_id):
+    """Return a list of (profile id, description), newest first."""
+    return g.cache.get(_recent_key(event_id)) or []
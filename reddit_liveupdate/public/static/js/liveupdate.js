@@ -13,19 +13,34 @@ r.liveupdate = {
             .scroll()  // in case of a short page / tall window
 
         if (r.config.liveupdate_websocket) {
-            this._websocket = new r.WebSocket(r.config.liveupdate_websocket)
-            this._websocket.on({
+            // these messages carry a sequence number so we can tell when
+            // we've missed some and fetch just those.
+            this._lastSeq = r.config.liveupdate_last_seq || null
+            this._queuedMessages = []
+            this._sequencedHandlers = {
+                'delete': this._onDelete,
+                'strike': this._onStrike,
+                'settings': this._onSettingsChanged,
+                'update': this._onNewUpdate
+            }
+
+            var handlers = {
                 'connecting': this._onWebSocketConnecting,
                 'connected': this._onWebSocketConnected,
                 'disconnected': this._onWebSocketDisconnected,
                 'reconnecting': this._onWebSocketReconnecting,
-                'message:delete': this._onDelete,
-                'message:strike': this._onStrike,
                 'message:activity': this._onActivityUpdated,
-                'message:refresh': this._onRefresh,
-                'message:settings': this._onSettingsChanged,
-                'message:update': this._onNewUpdate
+                'message:batch': this._onBatch,
+                'message:refresh': this._onRefresh
+            }
+            _.each(this._sequencedHandlers, function (handler, type) {
+                handlers['message:' + type] = function (message) {
+                    this._onSequencedMessage(type, message)
+                }
             }, this)
+
+            this._websocket = new r.WebSocket(r.config.liveupdate_websocket)
+            this._websocket.on(handlers, this)
             this._websocket.start()
         }
 
@@ -71,6 +86,14 @@ r.liveupdate = {
     _onWebSocketConnected: function () {
         this.$statusField.removeClass('connecting')
                          .text(r._('updating in real time...'))
+
+        // pick up anything sent while we were reconnecting. on the first
+        // connect, anything missed since the page rendered shows up as a
+        // gap in the next message's sequence number and is caught up then.
+        if (this._hasConnected) {
+            this._catchUp()
+        }
+        this._hasConnected = true
     },
 
     _onWebSocketDisconnected: function () {
@@ -90,6 +113,67 @@ r.liveupdate = {
         }, this), delay)
     },
 
+    _onSequencedMessage: function (type, message) {
+        var queued = {
+            'type': type,
+            'seq': message.seq,
+            'payload': message.data
+        }
+
+        if (this._catchingUp) {
+            this._queuedMessages.push(queued)
+        } else if (this._lastSeq && message.seq > this._lastSeq + 1) {
+            this._queuedMessages.push(queued)
+            this._catchUp()
+        } else {
+            this._applyMessage(queued)
+        }
+    },
+
+    _onBatch: function (messages) {
+        // several sequenced messages sent close together, in order
+        _.each(messages, function (message) {
+            this._onSequencedMessage(message.type, message)
+        }, this)
+    },
+
+    _applyMessage: function (message) {
+        // we may see a message both from a catch-up and the websocket
+        if (this._lastSeq && message.seq <= this._lastSeq)
+            return
+
+        this._lastSeq = message.seq
+        this._sequencedHandlers[message.type].call(this, message.payload)
+    },
+
+    _catchUp: function () {
+        if (this._catchingUp || !this._lastSeq)
+            return
+
+        this._catchingUp = true
+
+        $.ajax({
+            'url': '/api/live/' + r.config.liveupdate_event + '/messages',
+            'data': {'after': this._lastSeq},
+            'dataType': 'json'
+        })
+            .done($.proxy(function (response) {
+                if (!response.complete) {
+                    this._onRefresh()
+                    return
+                }
+
+                _.each(response.messages, this._applyMessage, this)
+            }, this))
+            .always($.proxy(function () {
+                var queued = _.sortBy(this._queuedMessages, 'seq')
+
+                this._catchingUp = false
+                this._queuedMessages = []
+                _.each(queued, this._applyMessage, this)
+            }, this))
+    },
+
     _onRefresh: function () {
         // delay a random amount to reduce thundering herd
         var delay = Math.random() * 300 * 1000
@@ -0,0 +1,50 @@
+"""Bulk re-rendering of stored update bodies.
+
+Update bodies are rendered to HTML when they're written and the result is
+stored alongside the markdown. After bumping models.BODY_RENDERER_VERSION,
+run this to re-render everything up front rather than waiting for each
+update to be lazily backfilled on read:
+
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import rerender; rerender.rerender_all()'
+
+"""
+
+from pylons import g
+
+from reddit_liveupdate.models import LiveUpdate, LiveUpdateStream
+
+
+BATCH_SIZE = 500
+
+
+def rerender_row(rowkey):
+    rerendered = 0
+
+    with LiveUpdateStream._cf.batch(queue_size=BATCH_SIZE) as batch:
+        columns = LiveUpdateStream._cf.xget(
+            rowkey, buffer_size=BATCH_SIZE, include_timestamp=True)
+
+        for id, (data, timestamp) in columns:
+            update = LiveUpdate.from_json(id, data)
+            if not update.needs_render:
+                continue
+
+            # write just after the original so that a strike or delete made
+            # through the app in the meantime isn't clobbered
+            update.render_body()
+            batch.insert(rowkey, {update._id: update.to_json()},
+                         timestamp=timestamp + 1)
+            rerendered += 1
+
+    return rerendered
+
+
+def rerender_all():
+    # this works row by row so it doesn't care whether a row is an event's
+    # whole stream or one of its buckets
+    rowkeys = LiveUpdateStream._cf.get_range(
+        column_count=1, filter_empty=True)
+
+    for rowkey, columns in rowkeys:
+        count = rerender_row(rowkey)
+        g.log.info("Re-rendered %d updates in %r", count, rowkey)
@@ -6,6 +6,12 @@ from r2.lib.utils import UrlParser
 
 
 hooks = HookRegistrar()
+EMBED_WIDTH = 710
+EMBED_HEIGHT = 500
+_IFRAME_TEMPLATE = """\
+<iframe src="//{domain}/live/{event_id}/embed"
+        width="{width}" height="{height}">
+</iframe>"""
 _EMBED_TEMPLATE = """
 <!doctype html>
 <html>
@@ -17,14 +23,21 @@ iframe {{
 </style>
 </head>
 <body>
-<iframe src="//{domain}/live/{event_id}/embed"
-        width="{width}" height="{height}">
-</iframe>
+{iframe}
 </body>
 </html>
 """
 
 
+def make_embed_html(event_id, width=EMBED_WIDTH, height=EMBED_HEIGHT):
+    return _IFRAME_TEMPLATE.format(
+        event_id=event_id,
+        domain=g.media_domain,
+        width=width,
+        height=height,
+    )
+
+
 class _LiveUpdateScraper(Scraper):
     def __init__(self, event_id):
         self.event_id = event_id
@@ -44,14 +57,11 @@ class _LiveUpdateScraper(Scraper):
 
     @classmethod
     def media_embed(cls, media_object):
-        width = 710
-        height = 500
+        width = EMBED_WIDTH
+        height = EMBED_HEIGHT
 
         content = _EMBED_TEMPLATE.format(
-            event_id=media_object["event_id"],
-            domain=g.media_domain,
-            width=width,
-            height=height,
+            iframe=make_embed_html(media_object["event_id"], width, height),
         )
 
         return MediaEmbed(
@@ -0,0 +1,64 @@
+"""Move events' streams to the bucketed layout without downtime.
+
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import sharding; sharding.reshard_event("<event id>")'
+
+The event is first marked as "migrating" so that app servers write new
+changes to both layouts. Once in-flight requests have had a chance to finish
+the existing columns are copied into their buckets, keeping their original
+write timestamps so that a copy can never clobber a newer write made through
+the app in the meantime. Finally the event is switched over to read from the
+buckets. The original row is left in place but no longer receives writes.
+
+"""
+
+import time
+
+from pylons import g
+
+from reddit_liveupdate.models import (
+    LiveUpdateEvent,
+    LiveUpdateStream,
+    LiveUpdateStreamBucketsByEvent,
+)
+
+
+BATCH_SIZE = 500
+
+# how long to give requests that loaded the event before it was marked as
+# migrating to finish their writes.
+GRACE_PERIOD = 30
+
+
+def _set_layout(event, layout):
+    event.stream_layout = layout
+    event._commit()
+
+
+def reshard_event(event_id, grace_period=GRACE_PERIOD):
+    event = LiveUpdateEvent._byID(event_id)
+    if event.stream_layout == "bucketed":
+        return
+
+    _set_layout(event, "migrating")
+    time.sleep(grace_period)
+
+    copied = 0
+    buckets = set()
+    with LiveUpdateStream._cf.batch(queue_size=BATCH_SIZE) as batch:
+        columns = LiveUpdateStream._cf.xget(
+            event_id, buffer_size=BATCH_SIZE, include_timestamp=True)
+
+        for id, (value, timestamp) in columns:
+            bucket = LiveUpdateStream.bucket_for_id(id)
+            if bucket not in buckets:
+                LiveUpdateStreamBucketsByEvent.add_buckets(event_id, [bucket])
+                buckets.add(bucket)
+
+            rowkey = LiveUpdateStream.bucket_rowkey(event_id, bucket)
+            batch.insert(rowkey, {id: value}, timestamp=timestamp)
+            copied += 1
+
+    _set_layout(event, "bucketed")
+    g.log.info("Moved %d updates in %r into %d buckets",
+               copied, event_id, len(buckets))
+
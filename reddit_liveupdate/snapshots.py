@@ -0,0 +1,130 @@
+"""Static snapshots of completed events.
+
+Once an event is complete its stream never changes again, so the first
+logged-out render of its front page (in each format: HTML, JSON, RSS, embed)
+is stored gzipped in a blob store and every later request for that page is
+served from the store without querying its stream. Pages further back in
+the stream aren't snapshotted so that arbitrary cursors can't fill the store.
+
+Mark an event complete with:
+
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import snapshots; snapshots.complete_event("<event id>")'
+
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+from cStringIO import StringIO
+
+from pylons import g
+
+from r2.lib import websockets
+
+from reddit_liveupdate.models import LiveUpdateEvent
+
+
+_SAFE_EVENT_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class FilesystemSnapshotStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # someone else got there first
+                if not os.path.isdir(directory):
+                    raise
+
+        # write then rename so readers never see a partial snapshot
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+
+_STORES = {
+    "filesystem": lambda: FilesystemSnapshotStore(g.liveupdate_snapshot_path),
+}
+_store = None
+
+
+def get_store():
+    """Return the configured snapshot store, or None if disabled."""
+    global _store
+
+    store_name = getattr(g, "liveupdate_snapshot_store", "")
+    if not store_name:
+        return None
+
+    if not _store:
+        _store = _STORES[store_name]()
+    return _store
+
+
+def make_key(event_id, **params):
+    if not _SAFE_EVENT_ID.match(event_id):
+        return None
+
+    params_str = "&".join("%s=%s" % (k, params[k]) for k in sorted(params))
+    digest = hashlib.md5(params_str.encode("utf-8")).hexdigest()
+    return "%s/%s" % (event_id, digest)
+
+
+def get_snapshot(key):
+    """Return the gzipped snapshot stored under key, if any."""
+    store = get_store()
+    if not store or not key:
+        return None
+    return store.get(key)
+
+
+def save_snapshot(key, content):
+    store = get_store()
+    if not store or not key:
+        return
+
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(content)
+    store.put(key, buf.getvalue())
+
+
+def decompress(snapshot):
+    with gzip.GzipFile(fileobj=StringIO(snapshot)) as f:
+        return f.read()
+
+
+def complete_event(event_id):
+    event = LiveUpdateEvent._byID(event_id)
+    event.state = "complete"
+    event.mark_modified()
+    event._commit()
+
+    # anyone still watching should pick up the final version of the page
+    websockets.send_broadcast(
+        namespace="/live/" + event_id,
+        type="refresh",
+        payload=None,
+    )
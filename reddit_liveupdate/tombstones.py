@@ -0,0 +1,72 @@
+"""Move deleted updates out of events' streams.
+
+Deleted updates used to be left in the stream, marked as deleted, and were
+filtered out of listings after being read. Now they're moved to
+LiveUpdateDeletedUpdatesByEvent when deleted and each event's visible updates
+are counted in LiveUpdateCountsByEvent. This moves older events' deleted
+updates over and sets their counts:
+
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import tombstones; tombstones.migrate_event("<event id>")'
+    paster run $REDDIT_INI -c 'from reddit_liveupdate import tombstones; tombstones.migrate_all()'
+
+Migrating an event is safe to repeat. If updates are posted or deleted while
+an event is being migrated its count may be off by those; just migrate it
+again.
+
+"""
+
+from pylons import g
+
+from r2.lib.db import tdb_cassandra
+from r2.lib.utils import in_chunks
+
+from reddit_liveupdate.models import (
+    LiveUpdateCountsByEvent,
+    LiveUpdateDeletedUpdatesByEvent,
+    LiveUpdateEvent,
+    LiveUpdateStream,
+)
+
+
+BATCH_SIZE = 500
+
+
+def migrate_event(event_id):
+    event = LiveUpdateEvent._byID(event_id)
+
+    deleted = []
+    visible = 0
+    for update in LiveUpdateStream.iter_updates(event, chunk_size=BATCH_SIZE):
+        if update.is_deleted:
+            deleted.append(update)
+        else:
+            visible += 1
+
+    for chunk in in_chunks(deleted, size=BATCH_SIZE):
+        LiveUpdateDeletedUpdatesByEvent.add_updates(event, chunk)
+        LiveUpdateStream.remove_updates(event, [update._id
+                                                for update in chunk])
+
+    # counters can only be added to, so add whatever it's off by
+    current = LiveUpdateCountsByEvent.get_visible(event_id)
+    if current != visible:
+        LiveUpdateCountsByEvent.add_visible(event_id, visible - current)
+
+    event.has_update_count = True
+    event._commit()
+
+    g.log.info("Moved %d deleted updates out of %r, %d left",
+               len(deleted), event_id, visible)
+
+
+def migrate_all():
+    # bucketed events' rows are keyed "<event id>:<day>"
+    rowkeys = LiveUpdateStream._cf.get_range(
+        column_count=1, filter_empty=True)
+    event_ids = set(rowkey.split(":")[0] for rowkey, columns in rowkeys)
+
+    for event_id in sorted(event_ids):
+        try:
+            migrate_event(event_id)
+        except tdb_cassandra.NotFound:
+            g.log.warning("Skipping stream %r with no event", event_id)
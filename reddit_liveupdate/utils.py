@@ -1,3 +1,4 @@
+import calendar
 import datetime
 import itertools
 
@@ -13,19 +14,35 @@ def pairwise(iterable):
     return itertools.izip(a, b)
 
 
-def pretty_time(dt):
-    display_tz = pytz.timezone(c.liveupdate_event.timezone)
-    today = datetime.datetime.now(display_tz).date()
-    date = dt.astimezone(display_tz).date()
+# formatted times only depend on these things and are the same for every
+# request, so they're shared across the whole process.
+_PRETTY_TIME_CACHE_SIZE = 10000
+_pretty_time_cache = {}
 
-    if date == today:
+
+def _get_display_context():
+    """Return (timezone name, timezone, today) for the current request."""
+    tzname = c.liveupdate_event.timezone
+    context = getattr(c, "liveupdate_display_context", None)
+
+    if not context or context[0] != tzname:
+        display_tz = pytz.timezone(tzname)
+        today = datetime.datetime.now(display_tz).date()
+        context = (tzname, display_tz, today)
+        c.liveupdate_display_context = context
+
+    return context
+
+
+def _format_pretty_time(dt, display_tz, format_class):
+    if format_class == "today":
         return format_time(
             time=dt,
             tzinfo=display_tz,
             format="HH:mm z",
             locale=c.locale,
         )
-    elif today - date < datetime.timedelta(days=365):
+    elif format_class == "this_year":
         return format_datetime(
             datetime=dt,
             tzinfo=display_tz,
@@ -39,3 +56,45 @@ def pretty_time(dt):
             format="dd MMM YYYY HH:mm z",
             locale=c.locale,
         )
+
+
+def _memoized_format(key, format_fn):
+    try:
+        return _pretty_time_cache[key]
+    except KeyError:
+        pass
+
+    if len(_pretty_time_cache) >= _PRETTY_TIME_CACHE_SIZE:
+        _pretty_time_cache.clear()
+
+    formatted = _pretty_time_cache[key] = format_fn()
+    return formatted
+
+
+def pretty_time(dt):
+    tzname, display_tz, today = _get_display_context()
+    date = dt.astimezone(display_tz).date()
+
+    if date == today:
+        format_class = "today"
+    elif today - date < datetime.timedelta(days=365):
+        format_class = "this_year"
+    else:
+        format_class = "older"
+
+    minute = calendar.timegm(dt.utctimetuple()) // 60
+    key = (tzname, str(c.locale), minute, format_class)
+    return _memoized_format(
+        key, lambda: _format_pretty_time(dt, display_tz, format_class))
+
+
+def long_time(dt):
+    tzname, display_tz, today = _get_display_context()
+    second = calendar.timegm(dt.utctimetuple())
+    key = (tzname, str(c.locale), second, "long")
+    return _memoized_format(key, lambda: format_datetime(
+        datetime=dt,
+        tzinfo=display_tz,
+        format="long",
+        locale=c.locale,
+    ))
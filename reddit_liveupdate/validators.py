@@ -25,16 +25,29 @@ class VLiveUpdateID(Validator):
             return
 
 
+class VTimeUUID(Validator):
+    def run(self, id):
+        if not id:
+            return
+
+        return models.LiveUpdate.parse_id(id)
+
+
 class VLiveUpdate(VLiveUpdateID):
     def run(self, fullname):
         id = VLiveUpdateID.run(self, fullname)
 
         if id:
             try:
-                return models.LiveUpdateStream.get_update(
+                update = models.LiveUpdateStream.get_update(
                     c.liveupdate_event, id)
             except tdb_cassandra.NotFound:
                 pass
+            else:
+                # events that haven't had their deleted updates migrated out
+                # (see tombstones.py) still have them in the stream
+                if not update.deleted:
+                    return update
 
         self.set_error(errors.NO_THING_ID)
 
@@ -51,6 +64,15 @@ class VLiveUpdateEventReporter(Validator):
             abort(403, "Forbidden")
 
 
+class VLiveUpdateEventExporter(Validator):
+    """Reporters and admins may export an event even once it's over."""
+
+    def run(self):
+        if not (c.user_is_loggedin and
+                (c.user_is_admin or c.liveupdate_event.is_reporter(c.user))):
+            abort(403, "Forbidden")
+
+
 class VTimeZone(Validator):
     def run(self, timezone_name):
         try:
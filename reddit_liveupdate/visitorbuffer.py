@@ -0,0 +1,111 @@
+import atexit
+import collections
+import threading
+
+from pylons import g
+
+from r2.lib.db import tdb_cassandra
+
+from reddit_liveupdate.models import ActiveVisitorsByLiveUpdateEvent
+
+
+class VisitorBuffer(object):
+    """Coalesce visitor pixel hits into batched writes.
+
+    Hits are deduplicated per event in memory and written out by a background
+    thread every `flush_interval` seconds, or sooner once `flush_size` visitors
+    are pending. If more than `max_pending` visitors are waiting to be written
+    (e.g. because Cassandra is struggling) further hits are written through
+    synchronously rather than buffered.
+
+    """
+
+    def __init__(self, flush_size, flush_interval, max_pending):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(set)
+        self.num_pending = 0
+        self.flush_requested = threading.Event()
+        self.thread = None
+
+    def touch(self, event_id, hash):
+        with self.lock:
+            # the thread's started lazily so that it's running in the
+            # process that serves requests rather than whatever forked it
+            if not self.thread:
+                self._start()
+
+            hashes = self.pending[event_id]
+            if hash in hashes:
+                return
+
+            buffer_full = self.num_pending >= self.max_pending
+            if not buffer_full:
+                hashes.add(hash)
+                self.num_pending += 1
+
+                if self.num_pending >= self.flush_size:
+                    self.flush_requested.set()
+
+        if buffer_full:
+            ActiveVisitorsByLiveUpdateEvent.touch(event_id, hash)
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="liveupdate visitor buffer")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                g.log.exception("Failed to flush liveupdate visitors")
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = collections.defaultdict(set)
+            self.num_pending = 0
+
+        for event_id, hashes in pending.iteritems():
+            try:
+                ActiveVisitorsByLiveUpdateEvent.touch_multi(event_id, hashes)
+            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+                g.log.warning("Failed to write visitors for %r: %s",
+                              event_id, e)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def touch(event_id, hash):
+    """Record a visitor to an event, buffering the write if configured to."""
+    global _buffer
+
+    flush_interval = getattr(g, "liveupdate_pixel_flush_interval", 0)
+    if flush_interval <= 0:
+        ActiveVisitorsByLiveUpdateEvent.touch(event_id, hash)
+        return
+
+    if not _buffer:
+        with _buffer_lock:
+            if not _buffer:
+                _buffer = VisitorBuffer(
+                    flush_size=getattr(
+                        g, "liveupdate_pixel_flush_size", 1000),
+                    flush_interval=flush_interval,
+                    max_pending=getattr(
+                        g, "liveupdate_pixel_max_pending", 100000),
+                )
+
+    _buffer.touch(event_id, hash)